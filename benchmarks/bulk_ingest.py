@@ -0,0 +1,78 @@
+"""
+Compares score ingestion throughput of POST /api/scores/ (one request and
+one commit per score) with POST /api/scores/bulk/ (one request and one
+transaction per batch). Each bulk request also has a fixed cost, so the
+speedup shrinks with smaller batches, e.g. with --batch 100.
+
+    python benchmarks/bulk_ingest.py --scores 2000 --batch 500
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from frolftracker import create_app, db
+from frolftracker.models import Course, Player
+
+
+def _create_app(db_fname):
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True
+    })
+    with app.app_context():
+        db.create_all()
+        for i in range(10):
+            db.session.add(Player(name="bench-player-{}".format(i)))
+            db.session.add(Course(name="bench-course-{}".format(i)))
+        db.session.commit()
+    return app
+
+def _score(i):
+    return {
+        "throws": 50 + i % 20,
+        "date": "2020-06-{:02d}".format(1 + i % 28),
+        "player_id": 1 + i % 10,
+        "course_id": 1 + i % 10
+    }
+
+def bench_single(client, count):
+    start = time.perf_counter()
+    for i in range(count):
+        resp = client.post("/api/scores/", json=_score(i))
+        assert resp.status_code == 201
+    return count / (time.perf_counter() - start)
+
+def bench_bulk(client, count, batch):
+    start = time.perf_counter()
+    for offset in range(0, count, batch):
+        scores = [_score(i) for i in range(offset, min(offset + batch, count))]
+        resp = client.post("/api/scores/bulk/", json=scores)
+        assert resp.status_code == 200
+    return count / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scores", type=int, default=2000, help="scores to add per mode")
+    parser.add_argument("--batch", type=int, default=500, help="scores per bulk request")
+    args = parser.parse_args()
+
+    results = {}
+    for mode in ("single", "bulk"):
+        db_fd, db_fname = tempfile.mkstemp()
+        try:
+            client = _create_app(db_fname).test_client()
+            if mode == "single":
+                results[mode] = bench_single(client, args.scores)
+            else:
+                results[mode] = bench_bulk(client, args.scores, args.batch)
+        finally:
+            os.close(db_fd)
+            os.unlink(db_fname)
+        print("{:>6}: {:10.0f} scores/s".format(mode, results[mode]))
+
+    print("speedup: {:.1f}x".format(results["bulk"] / results["single"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Times every resource of the API against a synthetic database of
+configurable scale and reports p50/p95/p99 latency and throughput per
+endpoint. The results are saved as JSON so that runs can be compared.
+
+    python benchmarks/endpoints.py --players 10000 --courses 500 --scores 5000000 \\
+        --db /tmp/bench.db --output results.json --compare previous.json
+
+Requests go through the Flask test client, so the timings cover routing,
+queries and serialization but not the HTTP server. The response cache is
+disabled unless --cache is given, so every request reaches the database.
+A database given with --db is generated once and reused by later runs.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import date, timedelta
+
+from frolftracker import create_app, db
+from frolftracker.models import Course, Player, Score, load_data
+
+# Date range of the generated scores
+FIRST_DATE = date(2015, 1, 1)
+DAYS = 365 * 5
+
+def generate_dataset(app, players, courses, scores, seed):
+    """
+    Fills an empty database with random players, courses and scores with
+    the bulk loader of the load-data command.
+    """
+
+    with app.app_context():
+        load_data(players, courses, scores, seed=seed)
+        db.engine.dispose()
+
+def _score_json(rng, players, courses):
+    return {
+        "throws": rng.randint(45, 90),
+        "date": (FIRST_DATE + timedelta(days=rng.randrange(DAYS))).isoformat(),
+        "player_id": rng.randint(1, players),
+        "course_id": rng.randint(1, courses),
+    }
+
+def get_cases(players, courses, scores):
+    """
+    Returns the benchmarked requests as (name, method, make, uses) tuples,
+    where make(rng, created) returns the URL and JSON body of one request.
+    *created* holds the URLs of the resources added by the POST cases by
+    kind, and *uses* is the kind a case works on, so that e.g. the DELETE
+    cases remove those instead of the generated data.
+    """
+
+    def player(rng):
+        return rng.randint(1, players)
+
+    def course(rng):
+        return rng.randint(1, courses)
+
+    def score(rng):
+        return rng.randint(1, scores)
+
+    def window(rng):
+        start = FIRST_DATE + timedelta(days=rng.randrange(DAYS - 90))
+        return start.isoformat(), (start + timedelta(days=90)).isoformat()
+
+    return [
+        ("entry point", "GET", lambda rng, created: ("/api/", None)),
+
+        ("players page", "GET", lambda rng, created: (
+            "/api/players/?limit=100&after={}".format(player(rng)), None)),
+        ("player", "GET", lambda rng, created: ("/api/players/{}/".format(player(rng)), None)),
+        ("player stats", "GET", lambda rng, created: ("/api/players/{}/stats/".format(player(rng)), None)),
+        ("add player", "POST", lambda rng, created: (
+            "/api/players/", {"name": "new-player-{}".format(rng.random())})),
+        ("modify player", "PUT", lambda rng, created: (
+            "/api/players/{}/".format(player(rng)), {"name": "renamed-{}".format(rng.random())})),
+        ("delete player", "DELETE", lambda rng, created: (created["players"].pop(), None), "players"),
+
+        ("courses page", "GET", lambda rng, created: (
+            "/api/courses/?limit=100&after={}".format(course(rng)), None)),
+        ("course", "GET", lambda rng, created: ("/api/courses/{}/".format(course(rng)), None)),
+        ("leaderboard", "GET", lambda rng, created: ("/api/courses/{}/leaderboard/".format(course(rng)), None)),
+        ("leaderboard window", "GET", lambda rng, created: (
+            "/api/courses/{}/leaderboard/?from={}&to={}".format(course(rng), *window(rng)), None)),
+        ("add course", "POST", lambda rng, created: (
+            "/api/courses/", {"name": "new-course-{}".format(rng.random()), "num_holes": 18, "par": 54})),
+        ("modify course", "PUT", lambda rng, created: (
+            created["courses"][rng.randrange(len(created["courses"]))],
+            {"name": "renamed-{}".format(rng.random()), "num_holes": 9, "par": 27}), "courses"),
+        ("delete course", "DELETE", lambda rng, created: (created["courses"].pop(), None), "courses"),
+
+        ("scores page", "GET", lambda rng, created: (
+            "/api/scores/?limit=100&after={}".format(score(rng)), None)),
+        ("scores by player", "GET", lambda rng, created: (
+            "/api/scores/?player_id={}&limit=100".format(player(rng)), None)),
+        ("scores by course", "GET", lambda rng, created: (
+            "/api/scores/?course_id={}&limit=100".format(course(rng)), None)),
+        ("scores by player and course", "GET", lambda rng, created: (
+            "/api/scores/?player_id={}&course_id={}".format(player(rng), course(rng)), None)),
+        ("latest scores of player", "GET", lambda rng, created: (
+            "/api/scores/?player_id={}&order=desc&limit=20".format(player(rng)), None)),
+        ("scores in window", "GET", lambda rng, created: (
+            "/api/scores/?from={}&to={}&order=asc&limit=100".format(*window(rng)), None)),
+        ("scores expanded", "GET", lambda rng, created: (
+            "/api/scores/?course_id={}&expand=player,course&limit=100".format(course(rng)), None)),
+        ("score", "GET", lambda rng, created: ("/api/scores/{}/".format(score(rng)), None)),
+        ("add score", "POST", lambda rng, created: ("/api/scores/", _score_json(rng, players, courses))),
+        ("add scores in bulk", "POST", lambda rng, created: (
+            "/api/scores/bulk/", [_score_json(rng, players, courses) for _ in range(100)])),
+        ("modify score", "PUT", lambda rng, created: (
+            "/api/scores/{}/".format(score(rng)), _score_json(rng, players, courses))),
+        ("delete score", "DELETE", lambda rng, created: (created["scores"].pop(), None), "scores"),
+
+        ("changes", "GET", lambda rng, created: ("/api/changes/?since={}".format(rng.randint(0, 100)), None)),
+    ]
+
+CREATES = {"add player": "players", "add course": "courses", "add score": "scores"}
+
+def percentile(latencies, p):
+    return statistics.quantiles(latencies, n=100, method="inclusive")[p - 1]
+
+def run(client, cases, requests, seed):
+    rng = random.Random(seed)
+    created = {"players": [], "courses": [], "scores": []}
+    results = {}
+    for name, method, make, *uses in cases:
+        latencies = []
+        errors = 0
+        count = requests
+        if uses:
+            count = min(count, len(created[uses[0]]))
+        start = time.perf_counter()
+        for _ in range(count):
+            url, body = make(rng, created)
+            began = time.perf_counter()
+            resp = client.open(url, method=method, json=body)
+            latencies.append(time.perf_counter() - began)
+            if resp.status_code >= 400:
+                errors += 1
+            elif name in CREATES:
+                created[CREATES[name]].append(resp.headers["Location"])
+        elapsed = time.perf_counter() - start
+        if len(latencies) < 2:
+            continue
+        results[name] = {
+            "method": method,
+            "requests": len(latencies),
+            "errors": errors,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "mean_ms": statistics.mean(latencies) * 1000,
+            "throughput_rps": len(latencies) / elapsed,
+        }
+    return results
+
+def print_results(results, previous=None):
+    header = "{:<30} {:>6} {:>9} {:>9} {:>9} {:>10}".format(
+        "endpoint", "method", "p50 ms", "p95 ms", "p99 ms", "req/s"
+    )
+    if previous:
+        header += " {:>9}".format("p50 diff")
+    print(header)
+    for name, result in results.items():
+        line = "{:<30} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>10.0f}".format(
+            name, result["method"], result["p50_ms"], result["p95_ms"], result["p99_ms"],
+            result["throughput_rps"]
+        )
+        if previous and name in previous:
+            line += " {:>+8.0f}%".format((result["p50_ms"] / previous[name]["p50_ms"] - 1) * 100)
+        if result["errors"]:
+            line += "  ({} errors)".format(result["errors"])
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--players", type=int, default=10000)
+    parser.add_argument("--courses", type=int, default=500)
+    parser.add_argument("--scores", type=int, default=500000)
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="database file to create or reuse (default: temporary)")
+    parser.add_argument("--cache", action="store_true", help="keep the response cache enabled")
+    parser.add_argument("--output", default="benchmark-results.json", help="file to save the results to")
+    parser.add_argument("--compare", help="results file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    temporary = args.db is None
+    if temporary:
+        db_fd, db_fname = tempfile.mkstemp()
+        os.close(db_fd)
+        os.unlink(db_fname)
+    else:
+        db_fname = os.path.abspath(args.db)
+    generate = not os.path.exists(db_fname)
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "RESPONSE_CACHE_SIZE": 1024 if args.cache else 0,
+    })
+    try:
+        if generate:
+            start = time.perf_counter()
+            generate_dataset(app, args.players, args.courses, args.scores, args.seed)
+            print("generated dataset in {:.1f} s".format(time.perf_counter() - start))
+        else:
+            # Sizes of a reused database are read from it
+            with app.app_context():
+                args.players = db.session.query(Player).count()
+                args.courses = db.session.query(Course).count()
+                args.scores = db.session.query(db.func.max(Score.id)).scalar()
+
+        results = run(app.test_client(), get_cases(args.players, args.courses, args.scores), args.requests, args.seed)
+    finally:
+        with app.app_context():
+            db.engine.dispose()
+        if temporary:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_fname + suffix):
+                    os.unlink(db_fname + suffix)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+    print_results(results, previous)
+
+    document = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "machine": platform.machine(),
+            "players": args.players,
+            "courses": args.courses,
+            "scores": args.scores,
+            "requests": args.requests,
+            "cache": args.cache,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(document, f, indent=2)
+    print("results saved to {}".format(args.output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Measures requests/s of the production server (gunicorn.conf.py) with an
+increasing number of worker processes. Each run starts gunicorn against a
+temporary database and keeps it busy with keep-alive client processes
+requesting a mix of collections, items and leaderboards.
+
+    python benchmarks/load.py --workers 1 2 4 --clients 8 --seconds 10
+"""
+
+import argparse
+import http.client
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from frolftracker import create_app, db
+from frolftracker.models import load_data
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLAYERS = 50
+COURSES = 10
+
+def _populate(db_fname, scores):
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname})
+    with app.app_context():
+        db.create_all()
+        # load_data also builds the leaderboards from the scores
+        load_data(PLAYERS, COURSES, scores, seed=1)
+        db.engine.dispose()
+
+def _urls(i):
+    return [
+        "/api/scores/?player_id={}&limit=50".format(1 + i % PLAYERS),
+        "/api/players/{}/".format(1 + i % PLAYERS),
+        "/api/courses/{}/leaderboard/".format(1 + i % COURSES),
+        "/api/players/{}/stats/".format(1 + i % PLAYERS),
+    ]
+
+def _client(port, seconds, start, results):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    done = errors = i = 0
+    start.wait()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        i += 1
+        for url in _urls(i):
+            connection.request("GET", url)
+            resp = connection.getresponse()
+            resp.read()
+            if resp.status == 200:
+                done += 1
+            else:
+                errors += 1
+    connection.close()
+    results.put((done, errors))
+
+def _wait_until_up(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port)
+            connection.request("GET", "/api/")
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server didn't start")
+
+def bench(settings, workers, threads, clients, seconds, port):
+    env = dict(os.environ, FROLFTRACKER_SETTINGS=settings)
+    server = subprocess.Popen([
+        sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+        "--workers", str(workers), "--threads", str(threads),
+        "--bind", "127.0.0.1:{}".format(port), "--access-logfile", os.devnull,
+        "frolftracker.wsgi:app"
+    ], cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_until_up(port)
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=_client, args=(port, seconds, start, results))
+            for _ in range(clients)
+        ]
+        for process in processes:
+            process.start()
+        start.set()
+        done = errors = 0
+        for _ in processes:
+            client_done, client_errors = results.get()
+            done += client_done
+            errors += client_errors
+        for process in processes:
+            process.join()
+    finally:
+        server.terminate()
+        server.wait()
+    return done / seconds, errors
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=None,
+                        help="worker counts to measure (default: 1 up to the number of cores)")
+    parser.add_argument("--threads", type=int, default=4, help="threads per worker")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent client processes")
+    parser.add_argument("--seconds", type=float, default=10, help="duration of each run")
+    parser.add_argument("--scores", type=int, default=20000, help="scores in the database")
+    parser.add_argument("--port", type=int, default=5099)
+    args = parser.parse_args()
+    cores = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({1, 2, 4, cores} & set(range(1, cores + 1)))
+
+    db_fd, db_fname = tempfile.mkstemp()
+    settings_fd, settings = tempfile.mkstemp(suffix=".py")
+    try:
+        with os.fdopen(settings_fd, "w") as settings_file:
+            settings_file.write("SQLALCHEMY_DATABASE_URI = {!r}\n".format("sqlite:///" + db_fname))
+        _populate(db_fname, args.scores)
+
+        print("cores: {}".format(cores))
+        print("{:>8} {:>12} {:>8} {:>8}".format("workers", "requests/s", "scaling", "errors"))
+        baseline = None
+        for workers in worker_counts:
+            rate, errors = bench(settings, workers, args.threads, args.clients, args.seconds, args.port)
+            baseline = baseline or rate
+            print("{:>8} {:>12.0f} {:>7.2f}x {:>8}".format(workers, rate, rate / baseline, errors))
+    finally:
+        os.close(db_fd)
+        for path in (db_fname, db_fname + "-wal", db_fname + "-shm", settings):
+            if os.path.exists(path):
+                os.unlink(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Measures mixed read/write throughput against one SQLite database with the
+production storage profile (WAL, synchronous=NORMAL, mmap...) and with
+SQLite's defaults. Writer processes add scores one request at a time while
+reader processes page through the scores of a player.
+
+    python benchmarks/storage_profile.py --readers 4 --writers 1 --seconds 5
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from frolftracker import create_app, db
+from frolftracker.models import Course, Player, Score
+
+PLAYERS = 20
+
+def _create_app(db_fname, profile):
+    return create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLITE_PROFILE": profile,
+        # Every read must reach the database
+        "RESPONSE_CACHE_SIZE": 0,
+        "TESTING": True
+    })
+
+def _populate(db_fname, profile, scores):
+    app = _create_app(db_fname, profile)
+    with app.app_context():
+        db.create_all()
+        for i in range(PLAYERS):
+            db.session.add(Player(name="bench-player-{}".format(i)))
+        db.session.add(Course(name="bench-course"))
+        db.session.commit()
+        db.session.execute(db.insert(Score), [
+            {"throws": 50 + i % 20, "date": Score.date.type.python_type(2020, 1, 1 + i % 28),
+             "player_id": 1 + i % PLAYERS, "course_id": 1}
+            for i in range(scores)
+        ])
+        db.session.commit()
+        db.engine.dispose()
+
+def _worker(db_fname, profile, role, seconds, start, results):
+    client = _create_app(db_fname, profile).test_client()
+    done = errors = i = 0
+    start.wait()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        i += 1
+        if role == "writer":
+            resp = client.post("/api/scores/", json={
+                "throws": 54, "date": "2020-06-22", "player_id": 1 + i % PLAYERS, "course_id": 1
+            })
+            ok = resp.status_code == 201
+        else:
+            resp = client.get("/api/scores/?player_id={}&limit=50".format(1 + i % PLAYERS))
+            ok = resp.status_code == 200
+        if ok:
+            done += 1
+        else:
+            errors += 1
+    results.put((role, done, errors))
+
+def bench(profile, readers, writers, seconds, scores):
+    db_fd, db_fname = tempfile.mkstemp()
+    try:
+        _populate(db_fname, profile, scores)
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=_worker, args=(db_fname, profile, role, seconds, start, results))
+            for role in ["reader"] * readers + ["writer"] * writers
+        ]
+        for process in processes:
+            process.start()
+        start.set()
+        totals = {"reader": [0, 0], "writer": [0, 0]}
+        for _ in processes:
+            role, done, errors = results.get()
+            totals[role][0] += done
+            totals[role][1] += errors
+        for process in processes:
+            process.join()
+    finally:
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+    return {role: (done / seconds, errors) for role, (done, errors) in totals.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--readers", type=int, default=4, help="reader processes")
+    parser.add_argument("--writers", type=int, default=1, help="writer processes")
+    parser.add_argument("--seconds", type=float, default=5, help="duration of each run")
+    parser.add_argument("--scores", type=int, default=50000, help="scores in the database at start")
+    args = parser.parse_args()
+
+    print("{:<11} {:>10} {:>10} {:>8}".format("profile", "reads/s", "writes/s", "errors"))
+    for profile in ("default", "production"):
+        result = bench(profile, args.readers, args.writers, args.seconds, args.scores)
+        print("{:<11} {:>10.0f} {:>10.0f} {:>8}".format(
+            profile, result["reader"][0], result["writer"][0], result["reader"][1] + result["writer"][1]
+        ))
+
+if __name__ == "__main__":
+    main()
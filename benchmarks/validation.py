@@ -0,0 +1,41 @@
+"""
+Measures the cost of validating a request body per request, comparing
+jsonschema.validate with a freshly built schema (the previous behaviour)
+to the cached validators in frolftracker.utils.
+
+    python benchmarks/validation.py --repeat 20000
+"""
+
+import argparse
+import timeit
+
+from jsonschema import validate
+
+from frolftracker.models import Course, Player, Score
+from frolftracker.utils import validate_json
+
+DOCUMENTS = {
+    Player: {"name": "bench-player"},
+    Course: {"name": "bench-course", "num_holes": 18, "par": 54},
+    Score: {"throws": 54, "date": "2020-06-22", "player_id": 1, "course_id": 1},
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20000, help="validations per measurement")
+    args = parser.parse_args()
+
+    print("{:<8} {:>14} {:>14} {:>9}".format("model", "uncached (us)", "cached (us)", "speedup"))
+    for model, document in DOCUMENTS.items():
+        uncached = timeit.timeit(
+            lambda: validate(document, model.get_schema()), number=args.repeat
+        ) / args.repeat * 1e6
+        cached = timeit.timeit(
+            lambda: validate_json(document, model), number=args.repeat
+        ) / args.repeat * 1e6
+        print("{:<8} {:>14.2f} {:>14.2f} {:>8.1f}x".format(
+            model.__name__, uncached, cached, uncached / cached
+        ))
+
+if __name__ == "__main__":
+    main()
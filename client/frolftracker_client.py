@@ -5,10 +5,17 @@ Client for the frolftracker API.
 import curses
 
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
 from pick import pick
 API_URL = "http://localhost:5000"
+ENTRY_POINT = "/api/"
+# Seconds before cached controls are read again from the API
+CONTROL_TTL = 300
+# Maximum number of requests in flight at once, also the connection pool size
+MAX_WORKERS = 8
 
 # NOTE: This is borrowed from Lovelace exercise 4: "mumeta_submit.py".
 class APIError(Exception):
@@ -40,32 +47,121 @@ class APIError(Exception):
         )
 
 
+class ControlCache(object):
+    """
+    Cache of the hypermedia controls of the entry point and the collections.
+    Each document's @controls are read once and then served from memory
+    until they are older than *ttl* seconds or a request made with one of
+    them ends in 404, so looking up an href doesn't cost a round trip.
+    """
+
+    def __init__(self, ttl=CONTROL_TTL):
+        self.ttl = ttl
+        self._documents = {}
+
+    def controls(self, s, href):
+        """Returns the @controls of the document at *href*"""
+        cached = self._documents.get(href)
+        if cached is None or time.monotonic() - cached[0] > self.ttl:
+            resp = s.get(API_URL + href)
+            if resp.status_code != 200:
+                raise APIError(resp.status_code, resp.content)
+            cached = (time.monotonic(), resp.json()['@controls'])
+            self._documents[href] = cached
+        return cached[1]
+
+    def href(self, s, name, document=ENTRY_POINT):
+        """Returns the href of control *name* of the document at *document*"""
+        return self.controls(s, document)[name]['href']
+
+    def invalidate(self):
+        self._documents.clear()
+
+def get_control_cache(s):
+    """Returns the control cache of session *s*, creating it on first use"""
+    if not hasattr(s, 'frolf_controls'):
+        s.frolf_controls = ControlCache()
+    return s.frolf_controls
+
+def create_session(max_workers=MAX_WORKERS):
+    """
+    Creates a session whose connection pool can keep a connection open for
+    each of *max_workers* concurrent requests.
+    """
+    s = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    return s
+
+def fetch_many(s, fetch, ids, max_workers=MAX_WORKERS):
+    """
+    Calls fetch(s, id) for every distinct id in *ids* on a pool of at most
+    *max_workers* threads sharing session *s*. Returns a dict from id to
+    result, so repeated ids are only fetched once.
+    """
+    unique = list(dict.fromkeys(ids))
+    if not unique:
+        return {}
+    # Read the controls before fanning out so the workers don't all miss
+    # the control cache at once
+    get_control_cache(s).controls(s, ENTRY_POINT)
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(unique))) as pool:
+        return dict(zip(unique, pool.map(lambda id: fetch(s, id), unique)))
+
 def get_players_href(s):
-    resp = s.get(API_URL + '/api')
-    body = resp.json()
-    return body['@controls']['frolf:players-all']['href']
+    return get_control_cache(s).href(s, 'frolf:players-all')
 
 def get_courses_href(s):
-    resp = s.get(API_URL + '/api')
-    body = resp.json()
-    return body['@controls']['frolf:courses-all']['href']
+    return get_control_cache(s).href(s, 'frolf:courses-all')
 
 def get_scores_href(s):
-    resp = s.get(API_URL + '/api')
-    body = resp.json()
-    return body['@controls']['frolf:scores-all']['href']
+    return get_control_cache(s).href(s, 'frolf:scores-all')
+
+def get_by_control(s, name, path=''):
+    """
+    Sends a GET to the href of entry point control *name* followed by *path*.
+    A 404 may mean that the cached href is out of date, so the controls are
+    read again and the request is retried once.
+    """
+    resp = s.get(API_URL + get_control_cache(s).href(s, name) + path)
+    if resp.status_code == 404:
+        get_control_cache(s).invalidate()
+        resp = s.get(API_URL + get_control_cache(s).href(s, name) + path)
+    return resp
+
+def get_all_items(s, href):
+    """Returns items from every page of a collection by following "next" controls"""
+    items = []
+    while href:
+        body = s.get(API_URL + href).json()
+        items.extend(body['items'])
+        href = body['@controls'].get('next', {}).get('href')
+    return items
 
 def get_scores(s):
     scores_href = get_scores_href(s)
-    resp = s.get(API_URL + scores_href)
-    body = resp.json()
-    scores = body['items']
+    # Player and course names are embedded by the API, so listing the scores
+    # doesn't need extra requests per score
+    scores = get_all_items(s, scores_href + '?expand=player,course')
+    # Servers without "expand" support send plain scores. Their players and
+    # courses are then fetched concurrently, each of them only once.
+    players = fetch_many(s, get_player_by_id,
+        [str(score['player_id']) for score in scores if 'player_name' not in score])
+    courses = fetch_many(s, get_course_by_id,
+        [str(score['course_id']) for score in scores if 'course_name' not in score])
     ret = []
     for score in scores:
         throws = str(score['throws'])
         date = score['date']
-        player = get_player_by_id(s, str(score['player_id']))['name']
-        course = get_course_by_id(s, str(score['course_id']))['name']
+        if 'player_name' in score:
+            player = score['player_name']
+        else:
+            player = players[str(score['player_id'])]['name']
+        if 'course_name' in score:
+            course = score['course_name']
+        else:
+            course = courses[str(score['course_id'])]['name']
         ret.append({'id' : str(score['score_id']), 'throws' : throws, 'date' : date,
             'player' :  player, 'course' : course, 'player_id' : score['player_id'], 'course_id' : score['course_id']})
 
@@ -73,9 +169,7 @@ def get_scores(s):
 
 def get_players(s):
     players_href = get_players_href(s)
-    resp = s.get(API_URL + players_href)
-    body = resp.json()
-    players = body['items']
+    players = get_all_items(s, players_href)
     ret = []
     for player in players:
         ret.append({'player': player['name'], 'href': player['@controls']['self']['href']})
@@ -84,9 +178,7 @@ def get_players(s):
 
 def get_courses(s):
     courses_href = get_courses_href(s)
-    resp = s.get(API_URL + courses_href)
-    body = resp.json()
-    courses = body['items']
+    courses = get_all_items(s, courses_href)
     ret = []
     for course in courses:
         ret.append({'course': course['name'], 'par': course['par'], 'num_holes': course['num_holes'], \
@@ -96,30 +188,25 @@ def get_courses(s):
 
 
 def get_score_by_id(s, id):
-    scores_href = get_scores_href(s)
-    resp = s.get(API_URL + scores_href + id)
+    resp = get_by_control(s, 'frolf:scores-all', id + '/')
     body = resp.json()
 
     return body
 
 def get_player_by_id(s, id):
-    players_href = get_players_href(s)
-    resp = s.get(API_URL + players_href + id)
+    resp = get_by_control(s, 'frolf:players-all', id + '/')
     body = resp.json()
 
     return body
 
 def get_course_by_id(s, id):
-    courses_href= get_courses_href(s)
-    resp = s.get(API_URL + courses_href + id)
+    resp = get_by_control(s, 'frolf:courses-all', id + '/')
     body = resp.json()
 
     return body
 
 def delete_score_by_id(s, id):
-    scores_href = get_scores_href(s)
-    resp = s.get(API_URL + scores_href + id)
-    body = resp.json()
+    body = get_score_by_id(s, id)
     do_request(s, body['@controls']['frolf:delete'])
 
 def get_scores_for_pick(option):
@@ -209,7 +296,7 @@ def scores_menu(s):
     option, _ = pick(options, title)
 
     scores_href = get_scores_href(s)
-    body = s.get(API_URL + scores_href).json()
+    controls = get_control_cache(s).controls(s, scores_href)
     scores = get_scores(s)
     if option == "Get scores":
         try:
@@ -217,12 +304,12 @@ def scores_menu(s):
         except ValueError:
             prompt("No scores. \n   Enter to continue")
     elif option == "Add score":
-        prompt_from_schema(s, body["@controls"]["frolf:add-score"])
+        prompt_from_schema(s, controls["frolf:add-score"])
         prompt("Success! \n   Enter to continue")
     elif option == "Edit score":
         try:
             option, _ = pick(scores, "Select score to edit", options_map_func=get_scores_for_pick)
-            body = s.get(API_URL + scores_href + option['id']).json()
+            body = get_score_by_id(s, option['id'])
             prompt_from_schema_edit(s, body)
             prompt("Success! \n   Enter to continue")
         except ValueError:
@@ -244,7 +331,7 @@ def players_menu(s):
 
     option, _ = pick(options, title)
     players_href = get_players_href(s)
-    body = s.get(API_URL + players_href).json()
+    controls = get_control_cache(s).controls(s, players_href)
     players = get_players(s)
     if option == "Get players":
         try:
@@ -252,7 +339,7 @@ def players_menu(s):
         except ValueError:
             prompt("No players. \n   Enter to continue")
     elif option == "Add player":
-        prompt_from_schema(s, body["@controls"]["frolf:add-player"])
+        prompt_from_schema(s, controls["frolf:add-player"])
         prompt("Success! \n   Enter to continue")
     elif option == "Edit player":
         prompt("Not implemented")
@@ -270,7 +357,7 @@ def courses_menu(s):
 
     option, _ = pick(options, title)
     courses_href = get_courses_href(s)
-    body = s.get(API_URL + courses_href).json()
+    controls = get_control_cache(s).controls(s, courses_href)
     courses = get_courses(s)
     if option == "Get courses":
         try:
@@ -278,7 +365,7 @@ def courses_menu(s):
         except ValueError:
             prompt("No courses. \n   Enter to continue")
     elif option == "Add course":
-        prompt_from_schema(s, body["@controls"]["frolf:add-course"])
+        prompt_from_schema(s, controls["frolf:add-course"])
         prompt("Success! \n   Enter to continue")
     elif option == "Edit course":
         prompt("Not implemented")
@@ -305,7 +392,7 @@ def prompt(ps=None, value=''):
     return ret
 
 def main():
-    with requests.Session() as s:
+    with create_session() as s:
         while True:
             title = "Welcome to frolftracker!"
             options = ["Scores", "Players", "Courses", "Exit"]
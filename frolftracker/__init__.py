@@ -11,14 +11,60 @@ db = SQLAlchemy()
 # Modified to use Flask SQLAlchemy by Mika Oja (https://github.com/enkwolf/pwp-course-sensorhub-api-example/)
 def create_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True)
+    from .utils import MasonRequest
+    app.request_class = MasonRequest
     app.config.from_mapping(
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "development.db"),
-        SQLALCHEMY_TRACK_MODIFICATIONS=False
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        PAGE_SIZE=100,
+        MAX_PAGE_SIZE=1000,
+        STREAM_BATCH_SIZE=500,
+        BULK_MAX_ITEMS=5000,
+        RESPONSE_CACHE_SIZE=1024,
+        # Limit of the bodies in the response cache of each worker process
+        RESPONSE_CACHE_BYTES=32 * 1024 * 1024,
+        LEADERBOARD_SIZE=10,
+        LIVE_BUFFER_SIZE=100,
+        LIVE_HEARTBEAT=15,
+        LIVE_POLL_INTERVAL=0.5,
+        LIVE_RETENTION=300,
+        # Each live stream holds one of the SERVER_THREADS threads of a
+        # worker, keep this below it so that the other requests get served.
+        # The server accepts SERVER_WORKERS * LIVE_MAX_SUBSCRIBERS streams.
+        LIVE_MAX_SUBSCRIBERS=12,
+        COMPRESS_MIN_SIZE=1024,
+        COMPRESS_LEVEL=6,
+        SQLITE_PROFILE="production",
+        SQLITE_PRAGMAS={},
+        # "warn" or "error" checks the SQL statements of each API request
+        # against the query budget of its resource method
+        QUERY_BUDGET_MODE=None,
+        # Directory where each worker process writes its metrics for
+        # /metrics to add up, set by gunicorn.conf.py
+        METRICS_DIR=None,
+        METRICS_FLUSH_INTERVAL=5,
+        # Settings of the production server, see gunicorn.conf.py
+        SERVER_BIND="0.0.0.0:5000",
+        SERVER_WORKERS=os.cpu_count() or 1,
+        # Live score streams take up to LIVE_MAX_SUBSCRIBERS of the threads
+        SERVER_THREADS=16,
+        SERVER_MAX_REQUESTS=10000,
+        SERVER_MAX_REQUESTS_JITTER=1000,
+        SERVER_TIMEOUT=30,
+        SERVER_GRACEFUL_TIMEOUT=30,
+        # Pooled connections keep their pragmas and page cache. Only used
+        # for databases in files, see models.get_engine_options.
+        DATABASE_POOL={
+            "pool_size": 10,
+            "max_overflow": 10,
+            "pool_timeout": 10
+        }
     )
     
     if test_config is None:
         app.config.from_pyfile("config.py", silent=True)
+        app.config.from_envvar("FROLFTRACKER_SETTINGS", silent=True)
     else:
         app.config.from_mapping(test_config)
         
@@ -27,11 +73,37 @@ def create_app(test_config=None):
     except OSError:
         pass
     
+    from . import models
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = models.get_engine_options(app.config)
     db.init_app(app)
 
+    with app.app_context():
+        models.apply_storage_profile(db.engine, models.get_storage_pragmas(app.config))
+    app.cli.add_command(models.init_db_command)
+    app.cli.add_command(models.upgrade_db_command)
+    app.cli.add_command(models.load_data_command)
+
+    from . import leaderboard
+    app.cli.add_command(leaderboard.rebuild_leaderboards_command)
+
+    from .caching import ResponseCache
+    app.extensions["response_cache"] = ResponseCache(
+        app.config["RESPONSE_CACHE_SIZE"], app.config["RESPONSE_CACHE_BYTES"]
+    )
+
+    from .events import EventHub
+    app.extensions["event_hub"] = EventHub(app)
+
     from . import api
     app.register_blueprint(api.api_bp)
 
+    from . import metrics
+    with app.app_context():
+        metrics.init_app(app, db.engine)
+
+    from .compress import compress_response
+    app.after_request(compress_response)
+
     @app.route("/profiles/<profile>/")
     def send_profile(profile):
         return "you requests {} profile".format(profile)
@@ -40,4 +112,9 @@ def create_app(test_config=None):
     def send_link_relations():
         return "link relations"
 
+    @app.route("/stats/cache/")
+    def send_cache_stats():
+        stats = app.extensions["response_cache"].stats()
+        return Response(json.dumps(stats), 200, mimetype="application/json")
+
     return app
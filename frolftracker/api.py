@@ -1,21 +1,30 @@
 from flask import Blueprint
 from flask_restful import Api, Resource
 
+from frolftracker.metrics import start_request
 from frolftracker.resources.entry import EntryPoint
-from frolftracker.resources.player import PlayerItem, PlayerCollection
-from frolftracker.resources.course import CourseItem, CourseCollection
-from frolftracker.resources.score import ScoreItem, ScoreCollection
+from frolftracker.resources.player import PlayerItem, PlayerCollection, PlayerStats
+from frolftracker.resources.course import CourseItem, CourseCollection, CourseLeaderboard
+from frolftracker.resources.score import ScoreItem, ScoreCollection, ScoreBulk, ScoreStream
+from frolftracker.resources.change import ChangeFeed
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 api = Api(api_bp)
+api_bp.before_request(start_request)
 
 api.add_resource(EntryPoint, "/")
 
 api.add_resource(PlayerCollection, "/players/")
 api.add_resource(PlayerItem, "/players/<player_id>/")
+api.add_resource(PlayerStats, "/players/<player_id>/stats/")
 
 api.add_resource(CourseCollection, "/courses/")
 api.add_resource(CourseItem, "/courses/<course_id>/")
+api.add_resource(CourseLeaderboard, "/courses/<course_id>/leaderboard/")
 
 api.add_resource(ScoreCollection, "/scores/")
+api.add_resource(ScoreBulk, "/scores/bulk/")
+api.add_resource(ScoreStream, "/scores/live/")
 api.add_resource(ScoreItem, "/scores/<score_id>/")
+
+api.add_resource(ChangeFeed, "/changes/")
@@ -0,0 +1,213 @@
+import hashlib
+import threading
+from collections import OrderedDict, namedtuple
+from functools import partial, wraps
+from urllib.parse import urlencode
+from flask import Response, current_app, request
+from frolftracker.compress import compress_cached
+from frolftracker.models import bump_versions, get_versions
+from frolftracker.utils import get_media_type
+
+# "encoded" maps content codings to the compressed body
+CacheEntry = namedtuple("CacheEntry", ["etag", "tables", "body", "mimetype", "encoded"])
+
+class ResponseCache(object):
+    """
+    Bounded LRU cache of serialized GET responses, keyed by normalized
+    request URL. Every entry remembers the ETag it was created with and is
+    only served while the ETag still matches, so entries never outlive a
+    change to the tables they depend on even when the change was made by
+    another process. Writes in this process also evict the entries of the
+    changed tables right away through invalidate.
+
+    : param int max_entries: maximum number of responses kept, 0 disables
+    : param int max_bytes: maximum size of the kept bodies, plain and
+        compressed, in bytes
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._keys_by_table = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, etag):
+        """
+        Returns the entry for *key* if it was created with *etag*, or None.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.etag != etag:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        """
+        Stores *entry* under *key*, evicting least recently used entries
+        when the cache is full. Entries larger than the whole cache aren't
+        stored.
+        """
+
+        if self.max_entries <= 0 or _entry_size(entry) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self.size += _entry_size(entry)
+            for table in entry.tables:
+                self._keys_by_table.setdefault(table, set()).add(key)
+            self._evict()
+
+    def add_encoded(self, key, entry, coding, data):
+        """
+        Stores the body of *entry* compressed with *coding*, if the entry
+        is still cached under *key*, evicting other entries to make room.
+        """
+
+        with self._lock:
+            if self._entries.get(key) is not entry or coding in entry.encoded:
+                return
+            if _entry_size(entry) + len(data) > self.max_bytes:
+                return
+            entry.encoded[coding] = data
+            self.size += len(data)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate(self, *tables):
+        """
+        Removes every entry that depends on any of *tables*.
+        """
+
+        with self._lock:
+            for table in tables:
+                for key in list(self._keys_by_table.get(table, ())):
+                    self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= _entry_size(entry)
+        for table in entry.tables:
+            keys = self._keys_by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_table[table]
+
+def _entry_size(entry):
+    return len(entry.body) + sum(len(data) for data in entry.encoded.values())
+
+def get_cache():
+    return current_app.extensions["response_cache"]
+
+def touch(*models):
+    """
+    Records a change to the tables of *models* made by the current request:
+    bumps their version counters in the current transaction and evicts the
+    cached responses built from them. Every handler that inserts, updates
+    or deletes rows must call this before committing.
+    """
+
+    bump_versions(*models)
+    get_cache().invalidate(*[model.__tablename__ for model in models])
+
+def request_key():
+    """
+    Returns a normalized key for the resource representation requested by
+    the current request: the media type negotiated from the Accept header,
+    the path and the query parameters sorted by name, so that parameter
+    order doesn't matter.
+    """
+
+    query = urlencode(sorted(request.args.items(multi=True)))
+    return get_media_type() + " " + request.path + "?" + query
+
+def make_etag(key, versions):
+    """
+    Creates a strong entity tag for the representation identified by *key*
+    from the version counters of the tables it's built from.
+    """
+
+    key = "{}|{}".format(key, ",".join(str(version) for version in versions))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def cached_get(*models, depends=None):
+    """
+    Decorator for GET methods of resources whose representation only
+    depends on the rows of the tables of *models*. Sets an ETag on 200
+    responses, and answers a matching If-None-Match with 304 Not Modified
+    before the method runs, so no query is made and nothing is serialized.
+    Other requests are served from the response cache while the ETag of
+    the cached response is still current. Either way the only query needed
+    is the one that reads the version counters. Cached responses are
+    compressed once per content coding and kept compressed in the cache.
+
+    If the tables depend on query parameters, *depends* is called for each
+    request and the models it returns are added to *models*.
+    """
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            request_models = models
+            if depends is not None:
+                request_models += tuple(depends())
+            tables = tuple(model.__tablename__ for model in request_models)
+            key = request_key()
+            etag = make_etag(key, get_versions(*request_models))
+            # Compressed responses have weak ETags
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                response.vary.add("Accept")
+                return response
+
+            cache = get_cache()
+            entry = cache.get(key, etag)
+            if entry is not None:
+                response = Response(entry.body, 200, mimetype=entry.mimetype)
+                response.set_etag(etag)
+                response.vary.add("Accept")
+                compress_cached(response, entry.body, entry.encoded, partial(cache.add_encoded, key, entry))
+                return response
+
+            response = method(*args, **kwargs)
+            if response.status_code == 200:
+                response.set_etag(etag)
+                response.vary.add("Accept")
+                if not response.is_streamed:
+                    entry = CacheEntry(etag, tables, response.get_data(), response.mimetype, {})
+                    cache.put(key, entry)
+                    compress_cached(response, entry.body, entry.encoded, partial(cache.add_encoded, key, entry))
+            return response
+        return wrapper
+    return decorator
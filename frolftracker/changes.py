@@ -0,0 +1,47 @@
+from datetime import datetime, timezone
+from sqlalchemy import insert, literal, select
+from frolftracker import db
+from frolftracker.models import Change
+
+CREATE = "create"
+UPDATE = "update"
+DELETE = "delete"
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def record(model, resource_ids, operation):
+    """
+    Appends changes of the resources of *model* with the given IDs to the
+    change log as part of the current transaction. IDs of created resources
+    are only known after a flush.
+    """
+
+    if not isinstance(resource_ids, (list, tuple)):
+        resource_ids = [resource_ids]
+    if not resource_ids:
+        return
+    now = _now()
+    db.session.execute(insert(Change.__table__), [
+        {
+            "resource": model.__tablename__,
+            "resource_id": resource_id,
+            "operation": operation,
+            "time": now
+        }
+        for resource_id in resource_ids
+    ])
+
+def record_cascade(model, *criteria):
+    """
+    Records the deletion of every resource of *model* matching *criteria*,
+    e.g. the scores removed by a cascading delete of their player, with a
+    single INSERT ... SELECT. Must be called before the rows are deleted.
+    """
+
+    rows = select(
+        literal(model.__tablename__), model.id, literal(DELETE), literal(_now())
+    ).where(*criteria).order_by(model.id)
+    db.session.execute(insert(Change).from_select(
+        ["resource", "resource_id", "operation", "time"], rows
+    ))
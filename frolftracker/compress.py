@@ -0,0 +1,120 @@
+import gzip
+import zlib
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Media types that are never compressed: live streams must not be buffered
+UNCOMPRESSED_TYPES = {"text/event-stream"}
+
+def _gzip(data):
+    return gzip.compress(data, compresslevel=current_app.config["COMPRESS_LEVEL"], mtime=0)
+
+# Content codings by preference when the client accepts several of them.
+# brotli and zstd are only offered when their library is installed.
+CODINGS = {}
+if brotli is not None:
+    CODINGS["br"] = brotli.compress
+if zstandard is not None:
+    CODINGS["zstd"] = lambda data: zstandard.ZstdCompressor().compress(data)
+CODINGS["gzip"] = _gzip
+
+def get_coding():
+    """
+    Returns the content coding to use for the current request, chosen from
+    the Accept-Encoding header, or None if the response shouldn't be
+    compressed.
+    """
+
+    return request.accept_encodings.best_match(CODINGS)
+
+def is_compressible(response, size=None):
+    """
+    Returns True if *response* is worth compressing: it's not compressed
+    already, its media type can be compressed and its body has at least
+    COMPRESS_MIN_SIZE bytes. Streamed responses are always compressible.
+    """
+
+    if "Content-Encoding" in response.headers or response.direct_passthrough:
+        return False
+    if response.mimetype in UNCOMPRESSED_TYPES:
+        return False
+    if response.is_streamed:
+        return True
+    if size is None:
+        size = len(response.get_data())
+    return size >= current_app.config["COMPRESS_MIN_SIZE"]
+
+def _set_coding(response, coding):
+    # The ETag is made weak, since the bytes differ from the plain
+    # representation it was created for
+    response.headers["Content-Encoding"] = coding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+def compress_cached(response, body, encoded, store):
+    """
+    Compresses *response*, whose plain body *body* comes from a cache, with
+    the coding accepted by the client. *encoded* maps codings to the bodies
+    compressed earlier, and new ones are passed to store(coding, data), so
+    each of them is only compressed once however many times the entry is
+    served.
+    """
+
+    if not is_compressible(response, len(body)):
+        return
+    response.vary.add("Accept-Encoding")
+    coding = get_coding()
+    if coding is None:
+        return
+    data = encoded.get(coding)
+    if data is None:
+        data = CODINGS[coding](body)
+        store(coding, data)
+    response.set_data(data)
+    _set_coding(response, coding)
+
+def _gzip_stream(chunks, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def compress_response(response):
+    """
+    after_request hook that compresses responses that weren't compressed
+    already, e.g. from the response cache. Streamed responses are
+    compressed on the fly with gzip as they are sent.
+    """
+
+    if not is_compressible(response):
+        return response
+    response.vary.add("Accept-Encoding")
+    coding = get_coding()
+    if coding is None:
+        return response
+
+    if response.is_streamed:
+        if not request.accept_encodings.quality("gzip"):
+            return response
+        response.response = _gzip_stream(response.response, current_app.config["COMPRESS_LEVEL"])
+        response.headers.pop("Content-Length", None)
+        _set_coding(response, "gzip")
+        return response
+
+    response.set_data(CODINGS[coding](response.get_data()))
+    _set_coding(response, coding)
+    return response
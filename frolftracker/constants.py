@@ -1,6 +1,10 @@
 MASON = "application/vnd.mason+json"
+COMPACT = "application/vnd.frolftracker.compact+json"
 LINK_RELATIONS_URL = "/link-relations/"
 PLAYER_PROFILE = "/profiles/player/"
 COURSE_PROFILE = "/profiles/course/"
 SCORE_PROFILE = "/profiles/score/"
+LEADERBOARD_PROFILE = "/profiles/leaderboard/"
+PLAYER_STATS_PROFILE = "/profiles/player-stats/"
+CHANGE_PROFILE = "/profiles/change/"
 ERROR_PROFILE = "/profiles/error/"
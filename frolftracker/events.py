@@ -0,0 +1,209 @@
+import json
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from sqlalchemy import delete, func, insert, select
+from frolftracker import db
+from frolftracker.models import LiveEvent
+from frolftracker.utils import MasonBuilder
+
+CREATED = "score-created"
+UPDATED = "score-updated"
+DELETED = "score-deleted"
+
+class Subscription(object):
+    """
+    Bounded event buffer of one live stream subscriber. When the subscriber
+    falls behind, the oldest events are dropped instead of blocking the
+    publisher, and the number of dropped events is reported with the next
+    read so that the subscriber knows to resynchronize.
+
+    : param int max_events: size of the buffer
+    : param dict filters: attribute values an event must have to be delivered
+    """
+
+    def __init__(self, max_events, filters):
+        self.filters = filters
+        self.dropped = 0
+        self._events = deque(maxlen=max_events)
+        self._ready = threading.Condition()
+
+    def matches(self, data):
+        return all(data.get(name) == value for name, value in self.filters.items())
+
+    def push(self, event):
+        with self._ready:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+            self._events.append(event)
+            self._ready.notify()
+
+    def pop_all(self, timeout):
+        """
+        Waits at most *timeout* seconds for events. Returns the buffered
+        events and the number of events dropped since the previous call.
+        """
+
+        with self._ready:
+            if not self._events:
+                self._ready.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            dropped, self.dropped = self.dropped, 0
+            return events, dropped
+
+
+class EventHub(object):
+    """
+    Publish/subscribe hub for the live streams of one worker process. Score
+    events are written to the live_event table in the transaction of the
+    change, so they reach the subscribers of every worker process. While a
+    process has subscribers, a poller thread reads the events after its
+    cursor every LIVE_POLL_INTERVAL seconds and appends them to the buffers
+    of the matching subscribers, so it never waits for a subscriber to read.
+    Each open stream holds a server thread, so at most LIVE_MAX_SUBSCRIBERS
+    streams are accepted per process.
+
+    : param app: Flask app whose database and settings are used
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.max_events = app.config["LIVE_BUFFER_SIZE"]
+        self.max_subscribers = app.config["LIVE_MAX_SUBSCRIBERS"]
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._poll_lock = threading.Lock()
+        self._cursor = None
+        self._pruned = 0.0
+        self._thread = None
+        self._stop = None
+
+    def subscribe(self, **filters):
+        """
+        Returns a new subscription, or None if the process already has
+        LIVE_MAX_SUBSCRIBERS of them. Events written after the first
+        subscription of the process are delivered.
+        """
+
+        with self._lock:
+            if len(self._subscriptions) >= self.max_subscribers:
+                return None
+            subscription = Subscription(self.max_events, filters)
+            self._subscriptions.add(subscription)
+            if self._thread is None:
+                with self._poll_lock, self.app.app_context():
+                    self._cursor = db.session.scalar(select(func.max(LiveEvent.id))) or 0
+                self._stop = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._stop,), daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Removes a subscription. The poller thread is stopped with the last
+        one.
+        """
+
+        thread = None
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            if not self._subscriptions and self._thread is not None:
+                thread, self._thread = self._thread, None
+                self._stop.set()
+        if thread is not None:
+            thread.join()
+
+    def _deliver(self, event, data):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if subscription.matches(data):
+                subscription.push((event, data))
+
+    def poll(self):
+        """
+        Delivers the events written after the cursor to the subscribers and
+        removes events older than LIVE_RETENTION seconds once in a while.
+        Called by the poller thread.
+        """
+
+        with self._poll_lock, self.app.app_context():
+            if self._cursor is None:
+                return
+            rows = db.session.execute(
+                select(
+                    LiveEvent.id, LiveEvent.event, LiveEvent.score_id, LiveEvent.throws,
+                    LiveEvent.date, LiveEvent.player_id, LiveEvent.course_id
+                ).where(LiveEvent.id > self._cursor).order_by(LiveEvent.id)
+            ).all()
+            retention = self.app.config["LIVE_RETENTION"]
+            if time.monotonic() - self._pruned > retention / 10:
+                self._pruned = time.monotonic()
+                cutoff = _now() - timedelta(seconds=retention)
+                db.session.execute(delete(LiveEvent).where(LiveEvent.time < cutoff))
+            db.session.commit()
+            adapter = self.app.url_map.bind("")
+            for row in rows:
+                self._cursor = row.id
+                self._deliver(row.event, _event_data(row, adapter))
+
+    def _run(self, stop):
+        interval = self.app.config["LIVE_POLL_INTERVAL"]
+        while not stop.wait(interval):
+            try:
+                self.poll()
+            except Exception:
+                self.app.logger.exception("Polling live events failed")
+
+    def stats(self):
+        with self._lock:
+            return {"subscribers": len(self._subscriptions)}
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _event_data(row, adapter):
+    if row.event == DELETED:
+        return MasonBuilder(score_id=row.score_id, player_id=row.player_id, course_id=row.course_id)
+    data = MasonBuilder(
+        score_id=row.score_id, throws=row.throws, date=row.date.isoformat(),
+        player_id=row.player_id, course_id=row.course_id
+    )
+    data.add_control("self", adapter.build("api.scoreitem", {"score_id": row.score_id}))
+    return data
+
+def get_hub():
+    return current_app.extensions["event_hub"]
+
+def publish(event, scores):
+    """
+    Writes *event* of the given rounds to the live_event table as part of
+    the current transaction, with one statement however many rounds there
+    are. *scores* are (score_id, throws, date, player_id, course_id) tuples.
+    The subscribers get the event after the transaction has been committed.
+    """
+
+    now = _now()
+    db.session.execute(insert(LiveEvent.__table__), [
+        {
+            "event": event,
+            "score_id": score_id,
+            "throws": throws,
+            "date": played,
+            "player_id": player_id,
+            "course_id": course_id,
+            "time": now
+        }
+        for score_id, throws, played, player_id, course_id in scores
+    ])
+
+def format_event(event, data):
+    """
+    Formats one server-sent event.
+    """
+
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
@@ -0,0 +1,113 @@
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, func, insert, select
+from frolftracker import db
+from frolftracker.models import Course, LeaderboardEntry, Score, bump_versions
+
+# Rounds are ranked by throws, earlier rounds winning ties
+RANKING = (Score.throws, Score.date, Score.id)
+
+def refresh_courses(course_ids):
+    """
+    Replaces the leaderboards of the given courses with their current best
+    rounds, with one DELETE and one INSERT ... SELECT however many courses
+    there are. The best rounds of each course are read in throws order from
+    the (course_id, throws) index of the score table by a correlated
+    subquery, so the cost depends on the leaderboard size and not on the
+    number of rounds played on the courses.
+    """
+
+    course_ids = list(course_ids)
+    if not course_ids:
+        return
+    db.session.execute(delete(LeaderboardEntry).where(LeaderboardEntry.course_id.in_(course_ids)))
+    top = select(Score.id).where(Score.course_id == Course.id).order_by(*RANKING).limit(
+        current_app.config["LEADERBOARD_SIZE"]
+    ).correlate(Course)
+    best = select(
+        Score.course_id, Score.id, Score.throws, Score.date, Score.player_id
+    ).join(Course, Score.id.in_(top.scalar_subquery())).where(Course.id.in_(course_ids))
+    db.session.execute(insert(LeaderboardEntry).from_select(
+        ["course_id", "score_id", "throws", "date", "player_id"], best
+    ))
+
+def refresh_course(course_id):
+    """
+    Replaces the leaderboard of a course with its current best rounds.
+    """
+
+    refresh_courses([course_id])
+
+def score_changed(course_id, throws, score_id=None):
+    """
+    Updates the leaderboard of a course after a round on it was added,
+    changed or removed, as part of the current transaction. Must be called
+    after the change has been flushed. *throws* is the result of the round
+    and *score_id* the ID of a changed round. The leaderboard is only rebuilt
+    if the change can affect it: the round is on it, the round is good
+    enough to get on it, or the leaderboard isn't full (which is also the
+    case right after a listed round was deleted).
+    """
+
+    size, worst, listed = db.session.execute(
+        select(
+            func.count(),
+            func.max(LeaderboardEntry.throws),
+            func.count().filter(LeaderboardEntry.score_id == score_id)
+        ).where(LeaderboardEntry.course_id == course_id)
+    ).one()
+    if listed or size < current_app.config["LEADERBOARD_SIZE"] or throws <= worst:
+        refresh_course(course_id)
+
+def scores_added(best):
+    """
+    Updates the leaderboards after rounds were added on several courses at
+    once, as part of the current transaction, with one query for checking
+    the leaderboards and one refresh of those that change. *best* maps the
+    course IDs to the lowest throws added on them. Must be called after the
+    rounds have been flushed.
+    """
+
+    if not best:
+        return
+    size = current_app.config["LEADERBOARD_SIZE"]
+    boards = {
+        row.course_id: row
+        for row in db.session.execute(
+            select(
+                LeaderboardEntry.course_id,
+                func.count().label("size"),
+                func.max(LeaderboardEntry.throws).label("worst")
+            ).where(LeaderboardEntry.course_id.in_(list(best))).group_by(LeaderboardEntry.course_id)
+        )
+    }
+    refresh_courses(
+        course_id for course_id, throws in best.items()
+        if course_id not in boards or boards[course_id].size < size or throws <= boards[course_id].worst
+    )
+
+def player_removed(player_id):
+    """
+    Returns the IDs of the courses whose leaderboards list rounds of a
+    player. Must be called before the player is deleted, and the courses
+    refreshed with refresh_courses after the deletion has been flushed.
+    """
+
+    return db.session.scalars(
+        select(LeaderboardEntry.course_id).where(LeaderboardEntry.player_id == player_id).distinct()
+    ).all()
+
+@click.command("rebuild-leaderboards")
+@with_appcontext
+def rebuild_leaderboards_command():
+    '''
+    Rebuilds the leaderboards of every course from the score table, for
+    recovering from leaderboards that have gone out of sync.
+    '''
+    for course_id in db.session.scalars(select(Course.id)).all():
+        refresh_course(course_id)
+    # Leaderboard responses are cached by the Score version
+    bump_versions(Score)
+    db.session.commit()
+    click.echo("Leaderboards rebuilt")
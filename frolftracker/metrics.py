@@ -0,0 +1,388 @@
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from flask import Response, current_app, request
+from sqlalchemy import event
+from frolftracker.utils import create_error_response
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS = "text/plain; version=0.0.4; charset=utf-8"
+
+class EndpointMetrics(object):
+    """
+    Aggregated measurements of the requests to one endpoint and method.
+    Histogram buckets are kept non-cumulative and summed up when rendered.
+    """
+
+    __slots__ = ("buckets", "count", "duration", "response_bytes", "sql_statements", "sql_duration", "statuses")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.duration = 0.0
+        self.response_bytes = 0
+        self.sql_statements = 0
+        self.sql_duration = 0.0
+        self.statuses = {}
+
+    def to_dict(self):
+        values = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            values[name] = value.copy() if isinstance(value, (list, dict)) else value
+        return values
+
+    @classmethod
+    def from_dict(cls, values):
+        metrics = cls()
+        for name in cls.__slots__:
+            setattr(metrics, name, values[name])
+        metrics.statuses = {int(status): count for status, count in values["statuses"].items()}
+        return metrics
+
+    def add(self, other):
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.duration += other.duration
+        self.response_bytes += other.response_bytes
+        self.sql_statements += other.sql_statements
+        self.sql_duration += other.sql_duration
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+
+
+class Metrics(object):
+    """
+    In-process registry of per endpoint request metrics. Recording a
+    request is a few additions under a lock, so it only adds microseconds.
+
+    With several worker processes, each of them writes its registry and
+    the stats of its caches to a file of its own in *directory* every
+    *interval* seconds, and /metrics adds up the files of every worker,
+    like the multiprocess mode of prometheus_client. *stats* is a function
+    returning the cache and live stream stats of the process.
+    """
+
+    def __init__(self, directory=None, interval=5.0, stats=None):
+        self.directory = directory
+        self.interval = interval
+        self.stats = stats
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def record(self, endpoint, method, status, duration, size, sql_statements, sql_duration):
+        bucket = bisect_left(LATENCY_BUCKETS, duration)
+        with self._lock:
+            metrics = self._endpoints.get((endpoint, method))
+            if metrics is None:
+                metrics = self._endpoints[(endpoint, method)] = EndpointMetrics()
+            metrics.buckets[bucket] += 1
+            metrics.count += 1
+            metrics.duration += duration
+            metrics.response_bytes += size
+            metrics.sql_statements += sql_statements
+            metrics.sql_duration += sql_duration
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            if self.directory and (self._flusher is None or self._flusher[0] != os.getpid()):
+                # Threads don't survive a fork, each worker starts its own
+                thread = threading.Thread(target=self._flush_periodically, daemon=True)
+                self._flusher = (os.getpid(), thread)
+                thread.start()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                key: EndpointMetrics.from_dict(metrics.to_dict())
+                for key, metrics in self._endpoints.items()
+            }
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except OSError:
+                # The directory is removed when the server shuts down
+                return
+
+    def flush(self):
+        """
+        Writes the metrics of this process to its file in the directory.
+        """
+
+        cache_stats, live_stats = self.stats()
+        document = {
+            "endpoints": [
+                [endpoint, method, metrics.to_dict()]
+                for (endpoint, method), metrics in self.snapshot().items()
+            ],
+            "cache": {name: cache_stats[name] for name in CACHE_COUNTERS},
+            "gauges": {"cache_entries": cache_stats["entries"], "live_subscribers": live_stats["subscribers"]},
+        }
+        path = _worker_path(self.directory, os.getpid())
+        with open(path + ".tmp", "w") as f:
+            json.dump(document, f)
+        os.replace(path + ".tmp", path)
+
+    def collect(self):
+        """
+        Returns the metrics of every process as (snapshot, cache counters,
+        gauges by process ID), after writing those of this process.
+        """
+
+        if not self.directory:
+            cache_stats, live_stats = self.stats()
+            return self.snapshot(), {name: cache_stats[name] for name in CACHE_COUNTERS}, {
+                os.getpid(): {"cache_entries": cache_stats["entries"], "live_subscribers": live_stats["subscribers"]}
+            }
+        self.flush()
+        snapshot = {}
+        cache = dict.fromkeys(CACHE_COUNTERS, 0)
+        gauges = {}
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            document = _read_document(path)
+            if document is None:
+                continue
+            _add_document(snapshot, cache, document)
+            name = os.path.basename(path)[:-len(".json")]
+            if name.isdigit():
+                gauges[int(name)] = document["gauges"]
+        return snapshot, cache, gauges
+
+
+# Response cache stats that are counters, the others are gauges
+CACHE_COUNTERS = ("hits", "misses", "evictions")
+
+# Counters of exited workers are added up in this file
+ARCHIVE = "archive.json"
+
+def _worker_path(directory, pid):
+    return os.path.join(directory, "{}.json".format(pid))
+
+def _read_document(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _add_document(snapshot, cache, document):
+    for endpoint, method, values in document["endpoints"]:
+        metrics = EndpointMetrics.from_dict(values)
+        if (endpoint, method) in snapshot:
+            snapshot[endpoint, method].add(metrics)
+        else:
+            snapshot[endpoint, method] = metrics
+    for name in CACHE_COUNTERS:
+        cache[name] += document["cache"][name]
+
+def mark_process_dead(directory, pid):
+    """
+    Adds the counters of an exited worker process to the archive file and
+    removes the file of the process, so that totals don't go down when
+    workers are replaced. Called by the gunicorn master, one worker at a
+    time.
+    """
+
+    document = _read_document(_worker_path(directory, pid))
+    if document is None:
+        return
+    archive_path = os.path.join(directory, ARCHIVE)
+    archive = _read_document(archive_path) or {"endpoints": [], "cache": dict.fromkeys(CACHE_COUNTERS, 0)}
+    snapshot = {}
+    cache = dict.fromkeys(CACHE_COUNTERS, 0)
+    _add_document(snapshot, cache, archive)
+    _add_document(snapshot, cache, document)
+    merged = {
+        "endpoints": [
+            [endpoint, method, metrics.to_dict()]
+            for (endpoint, method), metrics in snapshot.items()
+        ],
+        "cache": cache,
+    }
+    with open(archive_path + ".tmp", "w") as f:
+        json.dump(merged, f)
+    os.replace(archive_path + ".tmp", archive_path)
+    os.unlink(_worker_path(directory, pid))
+
+
+def _labels(**labels):
+    return "{" + ",".join('{}="{}"'.format(name, value) for name, value in labels.items()) + "}"
+
+def render(snapshot, cache_stats, gauges):
+    """
+    Renders the metrics in the Prometheus text exposition format. Counters
+    are the totals of every worker process, the gauges of *gauges*, by
+    process ID, keep a worker label.
+    """
+
+    lines = []
+
+    def header(name, kind, description):
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, kind))
+
+    items = sorted(snapshot.items())
+    header("frolftracker_requests_total", "counter", "API requests by endpoint, method and status.")
+    for (endpoint, method), metrics in items:
+        for status, count in sorted(metrics.statuses.items()):
+            lines.append("frolftracker_requests_total{} {}".format(
+                _labels(endpoint=endpoint, method=method, status=status), count
+            ))
+
+    header("frolftracker_request_duration_seconds", "histogram", "Time spent handling API requests.")
+    for (endpoint, method), metrics in items:
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), metrics.buckets):
+            cumulative += count
+            lines.append("frolftracker_request_duration_seconds_bucket{} {}".format(
+                _labels(endpoint=endpoint, method=method, le=bound), cumulative
+            ))
+        labels = _labels(endpoint=endpoint, method=method)
+        lines.append("frolftracker_request_duration_seconds_sum{} {}".format(labels, metrics.duration))
+        lines.append("frolftracker_request_duration_seconds_count{} {}".format(labels, metrics.count))
+
+    for name, attribute, description in (
+        ("frolftracker_response_bytes_total", "response_bytes", "Bytes in API response bodies, after compression."),
+        ("frolftracker_sql_statements_total", "sql_statements", "SQL statements executed by API requests."),
+        ("frolftracker_sql_duration_seconds_total", "sql_duration", "Time spent executing SQL statements of API requests."),
+    ):
+        header(name, "counter", description)
+        for (endpoint, method), metrics in items:
+            lines.append("{}{} {}".format(name, _labels(endpoint=endpoint, method=method), getattr(metrics, attribute)))
+
+    for name in ("hits", "misses", "evictions"):
+        header("frolftracker_response_cache_{}_total".format(name), "counter", "Response cache {}.".format(name))
+        lines.append("frolftracker_response_cache_{}_total {}".format(name, cache_stats[name]))
+    for name, key, description in (
+        ("frolftracker_response_cache_entries", "cache_entries", "Responses in the response cache."),
+        ("frolftracker_live_subscribers", "live_subscribers", "Open live score streams."),
+    ):
+        header(name, "gauge", description)
+        for pid, values in sorted(gauges.items()):
+            lines.append("{}{} {}".format(name, _labels(worker=pid), values[key]))
+
+    return "\n".join(lines) + "\n"
+
+
+# Measurements of the current request: start time, SQL statements, SQL
+# time, start time of the statement being executed, the query budget of
+# the resource method and whether it is enforced. A context variable is
+# much cheaper to reach from the engine events than flask.g.
+_request_metrics = ContextVar("request_metrics", default=None)
+
+def start_request():
+    """
+    before_request hook of the API blueprint that starts measuring the
+    request.
+    """
+
+    _request_metrics.set([time.perf_counter(), 0, 0.0, 0.0, None, False])
+
+def query_budget(statements):
+    """
+    Declares the most SQL statements a resource method may execute, e.g.
+    @query_budget(2). The budget must not depend on the size of the data:
+    a method that runs a query per listed item has an N+1 problem. With the
+    QUERY_BUDGET_MODE setting the statements of each request are counted
+    against it. Put it above other decorators, such as cached_get, so that
+    it also covers their queries.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            measured = _request_metrics.get()
+            if measured is not None:
+                measured[4] = statements
+                measured[5] = current_app.config["QUERY_BUDGET_MODE"] == "error"
+            return func(*args, **kwargs)
+
+        wrapper.query_budget = statements
+        return wrapper
+    return decorator
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised in the "error" mode instead of executing a statement over the
+    query budget of the request, so that nothing the request wrote gets
+    committed.
+    """
+
+def _budget_exceeded(error):
+    return create_error_response(500, "Query budget exceeded", str(error))
+
+def _check_budget(response, statements, budget):
+    """
+    Adds the statement count and the budget of the request to the response
+    headers and logs a warning if the request went over its budget, which
+    only happens in the "warn" mode. Statements executed while a streamed
+    response is sent aren't counted.
+    """
+
+    if statements > budget:
+        current_app.logger.warning("{} {} executed {} SQL statements, over its budget of {}".format(
+            request.method, request.endpoint, statements, budget
+        ))
+    response.headers["X-Query-Count"] = str(statements)
+    response.headers["X-Query-Budget"] = str(budget)
+    return response
+
+def _finish_request(response):
+    measured = _request_metrics.get()
+    if measured is not None:
+        _request_metrics.set(None)
+        if measured[4] is not None and current_app.config["QUERY_BUDGET_MODE"]:
+            response = _check_budget(response, measured[1], measured[4])
+        current_app.extensions["metrics"].record(
+            request.endpoint or "unknown", request.method, response.status_code,
+            time.perf_counter() - measured[0], response.content_length or 0,
+            measured[1], measured[2]
+        )
+    return response
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    measured = _request_metrics.get()
+    if measured is not None:
+        if measured[5] and measured[1] >= measured[4]:
+            raise QueryBudgetExceeded("{} {} went over its budget of {} SQL statements".format(
+                request.method, request.endpoint, measured[4]
+            ))
+        measured[3] = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    measured = _request_metrics.get()
+    if measured is not None:
+        measured[1] += 1
+        measured[2] += time.perf_counter() - measured[3]
+
+def init_app(app, engine):
+    """
+    Records the requests measured by start_request and the SQL statements
+    they execute on *engine*, and adds the /metrics endpoint. Must be
+    called before other after_request hooks that change the response body,
+    such as compression, are registered, so that the recorded size is the
+    size that was sent.
+    """
+
+    app.extensions["metrics"] = Metrics(
+        app.config["METRICS_DIR"], app.config["METRICS_FLUSH_INTERVAL"],
+        lambda: (app.extensions["response_cache"].stats(), app.extensions["event_hub"].stats())
+    )
+    app.after_request(_finish_request)
+    app.register_error_handler(QueryBudgetExceeded, _budget_exceeded)
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+    @app.route("/metrics")
+    def send_metrics():
+        body = render(*app.extensions["metrics"].collect())
+        return Response(body, 200, content_type=PROMETHEUS)
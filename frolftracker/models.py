@@ -1,7 +1,16 @@
+import click
+import csv
+import itertools
+import os
+import random
+import time
+from datetime import date, timedelta
 from flask import Flask
+from flask.cli import with_appcontext
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.engine import Engine
+from sqlalchemy.engine import Engine, make_url
 from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import IntegrityError, OperationalError
 
 from frolftracker import db
@@ -12,6 +21,65 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor.execute("PRAGMA foreign_keys=ON")
     cursor.close()
 
+# Pragmas applied to every new SQLite connection, by storage profile. The
+# production profile lets readers run while a score is being written (WAL
+# journal), only syncs to disk at checkpoints, maps the database file into
+# memory and keeps a larger page cache for each pooled connection.
+STORAGE_PROFILES = {
+    "default": {},
+    "production": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+        "busy_timeout": 5000,
+        "temp_store": "MEMORY",
+    },
+}
+
+def get_storage_pragmas(config):
+    """
+    Returns the pragmas of the storage profile selected with SQLITE_PROFILE,
+    updated with the SQLITE_PRAGMAS of the config.
+    """
+
+    pragmas = dict(STORAGE_PROFILES[config["SQLITE_PROFILE"]])
+    pragmas.update(config["SQLITE_PRAGMAS"])
+    return pragmas
+
+def get_engine_options(config):
+    """
+    Returns the SQLALCHEMY_ENGINE_OPTIONS of the config with the DATABASE_POOL
+    settings added. In-memory SQLite databases use a StaticPool, which takes
+    no pool size, so they only get the options of the config.
+    """
+
+    options = dict(config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    in_memory = url.get_backend_name() == "sqlite" and (
+        url.database in (None, "", ":memory:") or url.query.get("mode") == "memory"
+    )
+    if not in_memory:
+        for name, value in config["DATABASE_POOL"].items():
+            options.setdefault(name, value)
+    return options
+
+def apply_storage_profile(engine, pragmas):
+    """
+    Registers a connect listener on *engine* that sets *pragmas* on each new
+    connection. Does nothing for other databases than SQLite.
+    """
+
+    if engine.dialect.name != "sqlite" or not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_storage_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA {}={}".format(name, value))
+        cursor.close()
+
 class Player(db.Model):
     '''
     Database model of a frolf player.
@@ -61,13 +129,27 @@ class Score(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     throws = db.Column(db.Integer, nullable=False)
-    date = db.Column(db.String, nullable=False)
+    date = db.Column(db.Date, nullable=False, index=True)
     player_id = db.Column(db.ForeignKey("player.id", ondelete="CASCADE"), nullable=False)
     course_id = db.Column(db.ForeignKey("course.id", ondelete="CASCADE"), nullable=False)
 
     course = db.relationship("Course", back_populates="scores", uselist=False)
     player = db.relationship("Player", back_populates="scores", uselist=False)
 
+    # Serve the player and course filters of the score collection as well as
+    # the cascading deletes from Player and Course without full table scans.
+    # (player_id, date) serves date ordered and date ranged player queries.
+    # The indexes on the bare filter columns end in the rowid, so they also
+    # serve the id ordered pages of the filtered collection without sorting.
+    __table_args__ = (
+        db.Index("ix_score_player_course_date", "player_id", "course_id", "date"),
+        db.Index("ix_score_course_throws", "course_id", "throws"),
+        db.Index("ix_score_player_date", "player_id", "date"),
+        db.Index("ix_score_player", "player_id"),
+        db.Index("ix_score_course", "course_id"),
+        db.Index("ix_score_player_course", "player_id", "course_id"),
+    )
+
     @staticmethod
     def get_schema():
         schema = {
@@ -86,7 +168,7 @@ class Score(db.Model):
         properties["date"] = {
             "description": "Date this round was played",
             "type": "string",
-            "pattern": "^[0-9]{4}-[01][0-9]-[0-3][0-9]"
+            "pattern": "^[0-9]{4}-[01][0-9]-[0-3][0-9]$"
         }
         properties["player_id"] = {
             "description": "ID of the player",
@@ -99,6 +181,13 @@ class Score(db.Model):
 
         return schema
 
+    @staticmethod
+    def get_bulk_schema():
+        return {
+            "type": "array",
+            "items": Score.get_schema()
+        }
+
 class Course(db.Model):
     ''' 
     Database model of a frolf course.
@@ -146,5 +235,277 @@ class Course(db.Model):
 
         return schema
 
+class LeaderboardEntry(db.Model):
+    '''
+    One of the best rounds of a course. Each course keeps its top
+    LEADERBOARD_SIZE rounds here, maintained by frolftracker.leaderboard
+    whenever scores change, so showing a leaderboard doesn't need a sort
+    over every score of the course.
+    Attributes:
+    course_id : ID of the course, part of the primary key
+    score_id : ID of the round, part of the primary key
+    throws : total strokes on the round
+    date : date the round was played on
+    player_id : ID of the player who played the round
+    '''
+
+    course_id = db.Column(db.ForeignKey("course.id", ondelete="CASCADE"), primary_key=True)
+    score_id = db.Column(db.ForeignKey("score.id", ondelete="CASCADE"), primary_key=True)
+    throws = db.Column(db.Integer, nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    player_id = db.Column(db.ForeignKey("player.id", ondelete="CASCADE"), nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_leaderboard_entry_course_throws", "course_id", "throws"),
+        db.Index("ix_leaderboard_entry_player", "player_id"),
+        db.Index("ix_leaderboard_entry_score", "score_id"),
+    )
+
+class Change(db.Model):
+    '''
+    Entry of the append-only change log of the API resources.
+    Attributes:
+    id : database id, primary key, increases with every change
+    resource : kind of the changed resource: player, course or score
+    resource_id : database id of the changed resource
+    operation : create, update or delete
+    time : UTC time of the change
+    '''
+
+    id = db.Column(db.Integer, primary_key=True)
+    resource = db.Column(db.String, nullable=False)
+    resource_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String, nullable=False)
+    time = db.Column(db.DateTime, nullable=False)
+
+class LiveEvent(db.Model):
+    '''
+    Score event waiting to be pushed to the live streams. Events are written
+    in the transaction of the change and read by every worker process that
+    has live subscribers, then removed after LIVE_RETENTION seconds. IDs
+    keep increasing after the table has been emptied.
+    Attributes:
+    id : database id, primary key, increases with every event
+    event : score-created, score-updated or score-deleted
+    score_id : database id of the round
+    throws : total strokes on the round
+    date : date the round was played on
+    player_id : ID of the player who played the round
+    course_id : ID of the course the round was played on
+    time : UTC time of the event
+    '''
+
+    id = db.Column(db.Integer, primary_key=True)
+    event = db.Column(db.String, nullable=False)
+    score_id = db.Column(db.Integer, nullable=False)
+    throws = db.Column(db.Integer, nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    player_id = db.Column(db.Integer, nullable=False)
+    course_id = db.Column(db.Integer, nullable=False)
+    time = db.Column(db.DateTime, nullable=False, index=True)
+
+    # The pollers only read events after their cursor, so IDs must not be
+    # reused after every event has been pruned
+    __table_args__ = {"sqlite_autoincrement": True}
+
+class TableVersion(db.Model):
+    '''
+    Version counter of a database table, used for ETags.
+    Attributes:
+    name : name of the table, primary key
+    version : number of times the table has been changed through the API
+    '''
+
+    name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+def bump_versions(*models):
+    '''
+    Increments the version counters of the tables of *models* as part of the
+    current transaction. Must be called by every handler that changes rows
+    of those tables, including rows removed by cascading deletes.
+    '''
+    stmt = sqlite_insert(TableVersion).values(
+        [{"name": model.__tablename__, "version": 1} for model in models]
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[TableVersion.name],
+        set_={"version": TableVersion.version + 1}
+    )
+    db.session.execute(stmt)
+
+def get_versions(*models):
+    '''
+    Returns the current version counters of the tables of *models* as a
+    tuple, in the same order. Tables that have never changed are at 0.
+    '''
+    names = [model.__tablename__ for model in models]
+    versions = dict(
+        db.session.query(TableVersion.name, TableVersion.version).filter(TableVersion.name.in_(names))
+    )
+    return tuple(versions.get(name, 0) for name in names)
+
+@click.command("init-db")
+@with_appcontext
 def init_db_command():
     db.create_all()
+
+# Tables whose secondary indexes are dropped during a bulk load and created
+# again afterwards, which is much faster than updating them row by row
+BULK_LOAD_TABLES = ("score", "leaderboard_entry")
+
+def _insert_batches(table, columns, rows, batch_size):
+    # Plain DBAPI executemany, one transaction per batch
+    statement = "INSERT INTO {} ({}) VALUES ({})".format(
+        table, ", ".join(columns), ", ".join("?" * len(columns))
+    )
+    rows = iter(rows)
+    count = 0
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return count
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql(statement, batch)
+        count += len(batch)
+
+def _generate_scores(count, player_ids, course_ids, rng, first_date=date(2015, 1, 1), days=365 * 5):
+    dates = [(first_date + timedelta(days=day)).isoformat() for day in range(days)]
+    throws = range(45, 91)
+    choice = rng.choice
+    for _ in range(count):
+        yield (choice(throws), choice(dates), choice(player_ids), choice(course_ids))
+
+def _read_csv(path, columns):
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield tuple(row[column] for column in columns)
+
+def load_data(players=0, courses=0, scores=0, csv_dir=None, seed=None, batch_size=100000, keep_indexes=False):
+    '''
+    Adds players, courses and scores to the database in bulk, bypassing the
+    ORM. Rows are generated randomly, or read from players.csv (name),
+    courses.csv (name, num_holes, par) and scores.csv (throws, date,
+    player_id, course_id) in *csv_dir*. Generated scores refer to random
+    existing players and courses. Unless *keep_indexes* is set, the indexes
+    of the score and leaderboard tables are dropped during the load and
+    created again after it. Then the leaderboards are rebuilt
+    and the version counters bumped so that cached responses are dropped.
+    Loaded rows are not recorded in the change feed.
+
+    Returns the number of players, courses and scores added.
+    '''
+    from frolftracker import leaderboard
+
+    db.create_all()
+    rng = random.Random(seed)
+    indexes = []
+    if not keep_indexes:
+        indexes = [index for table in BULK_LOAD_TABLES for index in db.metadata.tables[table].indexes]
+    for index in indexes:
+        index.drop(bind=db.engine, checkfirst=True)
+
+    try:
+        if csv_dir is not None:
+            added_players = _insert_batches(
+                "player", ["name"], _read_csv(os.path.join(csv_dir, "players.csv"), ["name"]), batch_size
+            )
+            added_courses = _insert_batches(
+                "course", ["name", "num_holes", "par"],
+                _read_csv(os.path.join(csv_dir, "courses.csv"), ["name", "num_holes", "par"]), batch_size
+            )
+            score_rows = _read_csv(
+                os.path.join(csv_dir, "scores.csv"), ["throws", "date", "player_id", "course_id"]
+            )
+        else:
+            # Names get a suffix of the current row count so that repeated
+            # loads don't collide with the unique course names
+            offset = db.session.query(Course).count()
+            added_players = _insert_batches(
+                "player", ["name"], (("player-{}".format(i),) for i in range(players)), batch_size
+            )
+            added_courses = _insert_batches(
+                "course", ["name", "num_holes", "par"],
+                (("course-{}".format(offset + i), 18, 54 + i % 10) for i in range(courses)), batch_size
+            )
+            player_ids = db.session.scalars(db.select(Player.id)).all()
+            course_ids = db.session.scalars(db.select(Course.id)).all()
+            if scores and not (player_ids and course_ids):
+                raise click.UsageError("Scores need at least one player and one course")
+            score_rows = _generate_scores(scores, player_ids, course_ids, rng)
+        added_scores = _insert_batches(
+            "score", ["throws", "date", "player_id", "course_id"], score_rows, batch_size
+        )
+    finally:
+        db.session.commit()
+        for index in indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
+    for course_id in db.session.scalars(db.select(Course.id)).all():
+        leaderboard.refresh_course(course_id)
+    bump_versions(Player, Course, Score)
+    db.session.commit()
+    return added_players, added_courses, added_scores
+
+@click.command("load-data")
+@click.option("--players", default=0, help="Number of players to generate")
+@click.option("--courses", default=0, help="Number of courses to generate")
+@click.option("--scores", default=0, help="Number of scores to generate")
+@click.option("--csv-dir", type=click.Path(exists=True, file_okay=False),
+              help="Load players.csv, courses.csv and scores.csv from this directory instead")
+@click.option("--seed", type=int, default=None, help="Seed of the random generator")
+@click.option("--batch-size", default=100000, help="Rows inserted per transaction")
+@click.option("--keep-indexes", is_flag=True,
+              help="Don't drop the indexes during the load, faster for small loads into a large database")
+@with_appcontext
+def load_data_command(players, courses, scores, csv_dir, seed, batch_size, keep_indexes):
+    '''
+    Generates or loads players, courses and scores in bulk, for test,
+    staging and benchmark databases.
+    '''
+    start = time.perf_counter()
+    counts = load_data(players, courses, scores, csv_dir, seed, batch_size, keep_indexes)
+    elapsed = time.perf_counter() - start
+    click.echo("Loaded {} players, {} courses and {} scores in {:.1f} s ({:.0f} rows/min)".format(
+        *counts, elapsed, sum(counts) / elapsed * 60
+    ))
+
+@click.command("upgrade-db")
+@with_appcontext
+def upgrade_db_command():
+    '''
+    Brings an existing database up to date with the models: creates missing
+    tables and adds indexes that were introduced after the database was
+    created. Safe to run more than once.
+    '''
+    # Early live_event tables reused the IDs of pruned events. The events
+    # are only kept for a few minutes, so the table is simply recreated.
+    live_event = db.session.execute(db.text(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'live_event'"
+    )).scalar()
+    db.session.commit()
+    if live_event is not None and "AUTOINCREMENT" not in live_event.upper():
+        LiveEvent.__table__.drop(bind=db.engine)
+    db.create_all()
+    # Dates used to be free-form strings. Date columns are stored as
+    # YYYY-MM-DD, so anything after the date part has to go.
+    db.session.execute(db.text(
+        "UPDATE score SET date = substr(date, 1, 10) WHERE length(date) > 10"
+    ))
+    # The old format check accepted dates that don't exist, like 2020-02-30,
+    # which a date() modifier moves to another day. Such rows can't be read.
+    invalid = db.session.execute(db.text(
+        "SELECT id, date FROM score "
+        "WHERE date(date, '+0 days') IS NULL OR date(date, '+0 days') != date ORDER BY id"
+    )).all()
+    if invalid:
+        db.session.rollback()
+        raise click.ClickException("Scores with invalid dates, fix them and run upgrade-db again:\n" + "\n".join(
+            "  score {}: {}".format(score_id, played) for score_id, played in invalid
+        ))
+    db.session.commit()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+    click.echo("Database upgraded")
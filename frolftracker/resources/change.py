@@ -0,0 +1,58 @@
+from flask import url_for
+from flask_restful import Resource
+from frolftracker import db
+from frolftracker.constants import *
+from frolftracker.metrics import query_budget
+from frolftracker.models import Change
+from frolftracker.utils import create_error_response, FrolftrackerBuilder, get_int_arg, get_limit_arg, mason_response
+
+# Endpoint and URL argument of the item resource for each kind of change
+RESOURCE_ITEMS = {
+    "player": ("api.playeritem", "player_id"),
+    "course": ("api.courseitem", "course_id"),
+    "score": ("api.scoreitem", "score_id"),
+}
+
+class ChangeFeed(Resource):
+
+    @query_budget(1)
+    def get(self):
+        try:
+            since = get_int_arg("since", 0)
+            limit = get_limit_arg()
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        # Only the changes after the cursor are read, with a seek on the
+        # primary key, so an up to date consumer gets an empty page cheaply
+        rows = db.session.query(
+            Change.id, Change.resource, Change.resource_id, Change.operation, Change.time
+        ).filter(Change.id > since).order_by(Change.id).limit(limit + 1).all()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        cursor = rows[-1].id if rows else since
+
+        body = FrolftrackerBuilder(cursor=cursor, more=more)
+        body.add_namespace("frolf", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.changefeed", since=since, limit=limit))
+        body.add_control("profile", CHANGE_PROFILE)
+        body.add_control(
+            "next",
+            url_for("api.changefeed", since=cursor, limit=limit),
+            method="GET",
+            title="Changes after this page"
+        )
+        body["items"] = []
+        for change_id, resource, resource_id, operation, time in rows:
+            item = FrolftrackerBuilder(
+                change_id=change_id,
+                resource=resource,
+                id=resource_id,
+                operation=operation,
+                time=time.isoformat()
+            )
+            endpoint, argument = RESOURCE_ITEMS[resource]
+            item.add_control("about", url_for(endpoint, **{argument: resource_id}))
+            body["items"].append(item)
+
+        return mason_response(body)
@@ -1,34 +1,54 @@
-import json
-from jsonschema import validate, ValidationError
-from flask import request, Response, url_for
+from jsonschema import ValidationError
+from flask import current_app, request, Response, url_for
 from flask_restful import Resource
 from sqlalchemy.exc import IntegrityError
-from frolftracker import db
+from frolftracker import changes, db
 from frolftracker.constants import *
-from frolftracker.models import Course, Player, Score
-from frolftracker.utils import create_error_response, FrolftrackerBuilder
+from frolftracker.caching import cached_get, touch
+from frolftracker.metrics import query_budget
+from frolftracker.leaderboard import RANKING
+from frolftracker.models import Course, LeaderboardEntry, Player, Score
+from frolftracker.utils import (
+    collection_response, create_error_response, FrolftrackerBuilder, ItemSerializer, get_date_arg, get_fields_arg,
+    get_int_arg, get_page_args, keyset_page, mason_response, validate_json, wants_stream
+)
+
+COURSE_ITEM = ItemSerializer(
+    "api.courseitem", "course_id", Course.id, COURSE_PROFILE,
+    ("name", Course.name),
+    ("num_holes", Course.num_holes),
+    ("par", Course.par)
+)
 
 class CourseCollection(Resource):
     
+    @query_budget(2)
+    @cached_get(Course)
     def get(self):
         body = FrolftrackerBuilder()
 
         body.add_namespace("frolf", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.coursecollection"))
         body.add_control_add_course()
-        body["items"] = []
-        for db_course in Course.query.all():
-            item = FrolftrackerBuilder(
-                name=db_course.name,
-                num_holes=db_course.num_holes,
-                par=db_course.par
+
+        try:
+            serializer = get_fields_arg(COURSE_ITEM)
+            limit, after, before = get_page_args()
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        if wants_stream():
+            rows = serializer.select(Course.query).order_by(Course.id).yield_per(
+                current_app.config["STREAM_BATCH_SIZE"]
             )
-            item.add_control("self", url_for("api.courseitem", course_id=db_course.id))
-            item.add_control("profile", COURSE_PROFILE)
-            body["items"].append(item)
+            return collection_response(body, serializer, rows, stream=True)
+
+        page = keyset_page(serializer.select(Course.query), Course.id, limit, after, before)
+        body.add_control_pagination("api.coursecollection", page, limit, fields=request.args.get("fields"))
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return collection_response(body, serializer, page.rows)
 
+    @query_budget(4)
     def post(self):
         if not request.json:
             return create_error_response(
@@ -37,7 +57,7 @@ class CourseCollection(Resource):
             )
 
         try:
-            validate(request.json, Course.get_schema())
+            validate_json(request.json, Course)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
         
@@ -52,6 +72,9 @@ class CourseCollection(Resource):
 
         try:
             db.session.add(course)
+            db.session.flush()
+            changes.record(Course, course.id, changes.CREATE)
+            touch(Course)
             db.session.commit()
         except IntegrityError:
             return create_error_response(
@@ -66,6 +89,8 @@ class CourseCollection(Resource):
 
 class CourseItem(Resource):
 
+    @query_budget(2)
+    @cached_get(Course)
     def get(self, course_id):
         db_course = Course.query.filter_by(id=course_id).first()
         if db_course is None:
@@ -82,10 +107,12 @@ class CourseItem(Resource):
         body.add_control_delete_course(course_id)
         body.add_control_modify_course(course_id)
         body.add_control_get_scores_by_course(course_id)
+        body.add_control_get_leaderboard(course_id)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
 
 
+    @query_budget(4)
     def put(self, course_id):
         db_course = Course.query.filter_by(id=course_id).first()
         if db_course is None:
@@ -101,7 +128,7 @@ class CourseItem(Resource):
             )
 
         try:
-            validate(request.json, Course.get_schema())
+            validate_json(request.json, Course)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -110,6 +137,8 @@ class CourseItem(Resource):
         db_course.par = request.json["par"]
 
         try:
+            changes.record(Course, db_course.id, changes.UPDATE)
+            touch(Course)
             db.session.commit()
         except IntegrityError:
             return create_error_response(
@@ -120,6 +149,7 @@ class CourseItem(Resource):
         return Response(status=204)
 
 
+    @query_budget(8)
     def delete(self, course_id):
         db_course = Course.query.filter_by(id=course_id).first()
         if db_course is None:
@@ -128,6 +158,74 @@ class CourseItem(Resource):
                 "No course found with the id {}".format(course_id)
             )
 
+        changes.record_cascade(Score, Score.course_id == db_course.id)
+        changes.record(Course, db_course.id, changes.DELETE)
         db.session.delete(db_course)
+        touch(Course, Score)
         db.session.commit()
         return Response(status=204)
+
+
+class CourseLeaderboard(Resource):
+
+    @query_budget(3)
+    @cached_get(Course, Player, Score)
+    def get(self, course_id):
+        db_course = Course.query.filter_by(id=course_id).first()
+        if db_course is None:
+            return create_error_response(
+                404, "Not found",
+                "No course found with the id {}".format(course_id)
+            )
+
+        try:
+            date_from = get_date_arg("from")
+            date_to = get_date_arg("to")
+            limit = get_int_arg("limit", current_app.config["LEADERBOARD_SIZE"], minimum=1)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        if date_from is None and date_to is None:
+            # All time best rounds come from the maintained leaderboard table
+            query = db.session.query(
+                LeaderboardEntry.score_id, LeaderboardEntry.throws, LeaderboardEntry.date,
+                LeaderboardEntry.player_id, Player.name
+            ).join(Player, Player.id == LeaderboardEntry.player_id).filter(
+                LeaderboardEntry.course_id == db_course.id
+            ).order_by(LeaderboardEntry.throws, LeaderboardEntry.date, LeaderboardEntry.score_id)
+            limit = min(limit, current_app.config["LEADERBOARD_SIZE"])
+        else:
+            # Rounds within a date window are read in throws order from the
+            # (course_id, throws) index until enough of them match the window
+            query = db.session.query(
+                Score.id, Score.throws, Score.date, Score.player_id, Player.name
+            ).join(Player, Player.id == Score.player_id).filter(
+                Score.course_id == db_course.id
+            ).order_by(*RANKING)
+            if date_from is not None:
+                query = query.filter(Score.date >= date_from)
+            if date_to is not None:
+                query = query.filter(Score.date <= date_to)
+            limit = min(limit, current_app.config["MAX_PAGE_SIZE"])
+
+        body = FrolftrackerBuilder(course_id=db_course.id, name=db_course.name, par=db_course.par)
+        body.add_namespace("frolf", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.courseleaderboard", course_id=course_id))
+        body.add_control("profile", LEADERBOARD_PROFILE)
+        body.add_control("up", url_for("api.courseitem", course_id=course_id))
+        body["items"] = []
+        for rank, (score_id, throws, played, player_id, player_name) in enumerate(query.limit(limit), 1):
+            item = FrolftrackerBuilder(
+                rank=rank,
+                score_id=score_id,
+                throws=throws,
+                relative=throws - db_course.par,
+                date=played.isoformat(),
+                player_id=player_id,
+                player_name=player_name
+            )
+            item.add_control("self", url_for("api.scoreitem", score_id=score_id))
+            item.add_control("frolf:player", url_for("api.playeritem", player_id=player_id))
+            body["items"].append(item)
+
+        return mason_response(body)
@@ -1,16 +1,18 @@
 from flask_restful import Resource
-from flask import Response, url_for
-import json
-from frolftracker.utils import MasonBuilder
+from flask import url_for
+from frolftracker.metrics import query_budget
+from frolftracker.utils import MasonBuilder, mason_response
 from frolftracker.constants import *
 
 class EntryPoint(Resource):
 
+    @query_budget(0)
     def get(self):
         body = MasonBuilder()
         body.add_namespace("frolf", LINK_RELATIONS_URL)
         body.add_control("frolf:players-all", url_for("api.playercollection"))
         body.add_control("frolf:courses-all", url_for("api.coursecollection"))
         body.add_control("frolf:scores-all", url_for("api.scorecollection"))
+        body.add_control("frolf:changes", url_for("api.changefeed"))
         
-        return Response(json.dumps(body), status=200, mimetype=MASON)
+        return mason_response(body)
@@ -1,33 +1,74 @@
-import json
-from jsonschema import validate, ValidationError
-from flask import request, Response, url_for
+import math
+from jsonschema import ValidationError
+from flask import current_app, request, Response, url_for
 from flask_restful import Resource
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
-from frolftracker import db
+from frolftracker import changes, db, leaderboard
 from frolftracker.constants import *
+from frolftracker.caching import cached_get, touch
+from frolftracker.metrics import query_budget
 from frolftracker.models import Course, Player, Score
-from frolftracker.utils import create_error_response, FrolftrackerBuilder
+from frolftracker.utils import (
+    collection_response, create_error_response, FrolftrackerBuilder, ItemSerializer, get_fields_arg, get_page_args,
+    keyset_page, mason_response, validate_json, wants_stream
+)
+
+PLAYER_ITEM = ItemSerializer(
+    "api.playeritem", "player_id", Player.id, PLAYER_PROFILE,
+    ("name", Player.name)
+)
+
+def _score_aggregates():
+    # Sample variance from the sums, since SQLite has no stddev aggregate.
+    # Division by zero (a single round) gives NULL in SQLite.
+    count = func.count(Score.id)
+    total = func.sum(Score.throws)
+    variance = (func.sum(Score.throws * Score.throws) - total * total * 1.0 / count) / (count - 1)
+    return (
+        count.label("count"),
+        func.avg(Score.throws).label("mean"),
+        func.min(Score.throws).label("best"),
+        func.max(Score.throws).label("worst"),
+        variance.label("variance"),
+    )
+
+def _stats(row):
+    stddev = None
+    if row.variance is not None:
+        stddev = math.sqrt(max(row.variance, 0.0))
+    return dict(count=row.count, mean=row.mean, best=row.best, worst=row.worst, stddev=stddev)
 
 class PlayerCollection(Resource):
     
+    @query_budget(2)
+    @cached_get(Player)
     def get(self):
         body = FrolftrackerBuilder()
 
         body.add_namespace("frolf", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.playercollection"))
         body.add_control_add_player()
-        body["items"] = []
-        for db_player in Player.query.all():
-            item = FrolftrackerBuilder(
-                name=db_player.name
+
+        try:
+            serializer = get_fields_arg(PLAYER_ITEM)
+            limit, after, before = get_page_args()
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        if wants_stream():
+            rows = serializer.select(Player.query).order_by(Player.id).yield_per(
+                current_app.config["STREAM_BATCH_SIZE"]
             )
-            item.add_control("self", url_for("api.playeritem", player_id=db_player.id))
-            item.add_control("profile", PLAYER_PROFILE)
-            body["items"].append(item)
+            return collection_response(body, serializer, rows, stream=True)
+
+        page = keyset_page(serializer.select(Player.query), Player.id, limit, after, before)
+        body.add_control_pagination("api.playercollection", page, limit, fields=request.args.get("fields"))
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return collection_response(body, serializer, page.rows)
 
 
+    @query_budget(4)
     def post(self):
         if not request.json:
             return create_error_response(
@@ -36,7 +77,7 @@ class PlayerCollection(Resource):
             )
 
         try:
-            validate(request.json, Player.get_schema())
+            validate_json(request.json, Player)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -45,6 +86,9 @@ class PlayerCollection(Resource):
         )
 
         db.session.add(player)
+        db.session.flush()
+        changes.record(Player, player.id, changes.CREATE)
+        touch(Player)
         db.session.commit()
 
         return Response(status=201, headers={
@@ -54,6 +98,8 @@ class PlayerCollection(Resource):
 
 class PlayerItem(Resource):
 
+    @query_budget(2)
+    @cached_get(Player)
     def get(self, player_id):
         db_player = Player.query.filter_by(id=player_id).first()
         if db_player is None:
@@ -70,10 +116,12 @@ class PlayerItem(Resource):
         body.add_control_delete_player(player_id)
         body.add_control_modify_player(player_id)
         body.add_control_get_scores_by_player(player_id)
+        body.add_control_get_player_stats(player_id)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
 
 
+    @query_budget(4)
     def put(self, player_id):
         if not request.json:
             return create_error_response(
@@ -89,17 +137,20 @@ class PlayerItem(Resource):
             )
 
         try:
-            validate(request.json, Player.get_schema())
+            validate_json(request.json, Player)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
         db_player.name = request.json["name"]
 
+        changes.record(Player, db_player.id, changes.UPDATE)
+        touch(Player)
         db.session.commit()
 
         return Response(status=204)
 
 
+    @query_budget(11)
     def delete(self, player_id):
         db_player = Player.query.filter_by(id=player_id).first()
         if db_player is None:
@@ -108,7 +159,52 @@ class PlayerItem(Resource):
                 "No player found with the id {}".format(player_id)
             )
 
+        course_ids = leaderboard.player_removed(db_player.id)
+        changes.record_cascade(Score, Score.player_id == db_player.id)
+        changes.record(Player, db_player.id, changes.DELETE)
         db.session.delete(db_player)
+        db.session.flush()
+        leaderboard.refresh_courses(course_ids)
+        touch(Player, Score)
         db.session.commit()
 
         return Response(status=204)
+
+
+class PlayerStats(Resource):
+
+    @query_budget(4)
+    @cached_get(Player, Course, Score)
+    def get(self, player_id):
+        db_player = Player.query.filter_by(id=player_id).first()
+        if db_player is None:
+            return create_error_response(
+                404, "Not found",
+                "No player found with the id {}".format(player_id)
+            )
+
+        # Both aggregates are computed by SQLite from the player_id indexes,
+        # only the aggregated rows are loaded
+        overall = db.session.query(*_score_aggregates()).filter(Score.player_id == db_player.id).one()
+        per_course = db.session.query(
+            Course.id, Course.name, Course.par, *_score_aggregates()
+        ).join(Course, Course.id == Score.course_id).filter(
+            Score.player_id == db_player.id
+        ).group_by(Course.id).order_by(Course.id)
+
+        body = FrolftrackerBuilder(player_id=db_player.id, name=db_player.name, **_stats(overall))
+        body.add_namespace("frolf", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.playerstats", player_id=player_id))
+        body.add_control("profile", PLAYER_STATS_PROFILE)
+        body.add_control("up", url_for("api.playeritem", player_id=player_id))
+        body["courses"] = []
+        for row in per_course:
+            item = FrolftrackerBuilder(course_id=row.id, name=row.name, par=row.par, **_stats(row))
+            item.add_control("frolf:course", url_for("api.courseitem", course_id=row.id))
+            item.add_control(
+                "frolf:scores-by",
+                url_for("api.scorecollection", player_id=db_player.id, course_id=row.id)
+            )
+            body["courses"].append(item)
+
+        return mason_response(body)
@@ -1,19 +1,99 @@
-import json
-from jsonschema import validate, ValidationError
-from flask import request, Response, url_for
+from datetime import date
+from jsonschema import ValidationError
+from flask import current_app, request, Response, url_for
 from flask_restful import Resource
+from sqlalchemy import insert
 from sqlalchemy.exc import IntegrityError
-from frolftracker import db
+from sqlalchemy.orm import joinedload
+from frolftracker import changes, db, events, leaderboard
 from frolftracker.constants import *
+from frolftracker.caching import cached_get, touch
+from frolftracker.metrics import query_budget
 from frolftracker.models import Course, Player, Score
-from frolftracker.utils import create_error_response, FrolftrackerBuilder
+from frolftracker.utils import (
+    collection_response, create_error_response, FrolftrackerBuilder, ItemSerializer, MasonBuilder, get_date_arg,
+    get_fields_arg, get_int_arg, get_page_args, keyset_page, mason_response, order_by_keys, parse_date,
+    validate_json, wants_stream
+)
+
+SCORE_ITEM = ItemSerializer(
+    "api.scoreitem", "score_id", Score.id, SCORE_PROFILE,
+    ("score_id", Score.id),
+    ("throws", Score.throws),
+    ("date", Score.date, date.isoformat),
+    ("player_id", Score.player_id),
+    ("course_id", Score.course_id)
+)
+
+# Related resources that can be embedded in scores with "?expand="
+EXPANSIONS = {
+    "player": (Player, ("player_name", Player.name), Score.player_id),
+    "course": (Course, ("course_name", Course.name), Score.course_id),
+}
+
+def _get_expand():
+    value = request.args.get("expand")
+    if not value:
+        return []
+    names = value.split(",")
+    for name in names:
+        if name not in EXPANSIONS:
+            raise ValueError("Query parameter 'expand' must be a list of {}".format(", ".join(EXPANSIONS)))
+    return [name for name in EXPANSIONS if name in names]
+
+def _expanded_models():
+    try:
+        return [EXPANSIONS[name][0] for name in _get_expand()]
+    except ValueError:
+        return []
+
+def _parse_date_cursor(value):
+    # Cursors of date ordered pages are "<date>,<score id>"
+    played, score_id = value.split(",")
+    return parse_date(played), int(score_id)
 
 class ScoreCollection(Resource):
     
+    @query_budget(2)
+    @cached_get(Score, depends=_expanded_models)
     def get(self):
         # Get query parameters from request
-        player_id = request.args.get("player_id")
-        course_id = request.args.get("course_id")
+        try:
+            expand = _get_expand()
+            player_id = get_int_arg("player_id")
+            course_id = get_int_arg("course_id")
+            date_from = get_date_arg("from")
+            date_to = get_date_arg("to")
+            order = request.args.get("order")
+            if order not in (None, "asc", "desc"):
+                raise ValueError("Query parameter 'order' must be 'asc' or 'desc'")
+            limit, after, before = get_page_args(int if order is None else _parse_date_cursor)
+            serializer = get_fields_arg(SCORE_ITEM.extend(*[EXPANSIONS[name][1] for name in expand]))
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        # Without "order" scores are listed in the order they were added,
+        # otherwise by date with the ID breaking ties between equal dates
+        if order is None:
+            keys = (Score.id,)
+        else:
+            keys = (Score.date, Score.id)
+        descending = order == "desc"
+
+        # Filters are applied to Score directly so that every page is a
+        # single keyset query, whichever combination of filters is used
+        query = serializer.select(Score.query, *keys)
+        for name in expand:
+            model, _, foreign_key = EXPANSIONS[name]
+            query = query.join(model, model.id == foreign_key)
+        if player_id is not None:
+            query = query.filter(Score.player_id == player_id)
+        if course_id is not None:
+            query = query.filter(Score.course_id == course_id)
+        if date_from is not None:
+            query = query.filter(Score.date >= date_from)
+        if date_to is not None:
+            query = query.filter(Score.date <= date_to)
 
         body = FrolftrackerBuilder()
 
@@ -21,39 +101,24 @@ class ScoreCollection(Resource):
         body.add_control("self", url_for("api.scorecollection"))
         body.add_control("frolf:players-all", url_for("api.playercollection"))
         body.add_control("frolf:courses-all", url_for("api.coursecollection"))
+        body.add_control("frolf:scores-live", url_for("api.scorestream"))
         body.add_control_add_score()
-        body["items"] = []
-
-        # All scores
-        if course_id is None and player_id is None:
-            query = Score.query.all()
-        # Scores filtered by course AND player
-        elif course_id is not None and player_id is not None:
-            player = Player.query.filter_by(id=player_id).first()
-            query = player.scores.filter_by(course_id=course_id).all()
-        # Scores filtered by course
-        elif course_id is not None:
-            course = Course.query.filter_by(id=course_id).first()
-            query = course.scores
-        # Scores filtered by player
-        elif player_id is not None:
-            player = Player.query.filter_by(id=player_id).first()
-            query = player.scores
-
-        for db_score in query:
-            item = FrolftrackerBuilder(
-                score_id=db_score.id,
-                throws=db_score.throws,
-                date=db_score.date,
-                player_id=db_score.player_id,
-                course_id=db_score.course_id,
-            )
-            item.add_control("self", url_for("api.scoreitem", score_id=db_score.id))
-            item.add_control("profile", SCORE_PROFILE)
-            body["items"].append(item)
+        body.add_control_add_scores()
+
+        if wants_stream():
+            rows = order_by_keys(query, keys, descending).yield_per(current_app.config["STREAM_BATCH_SIZE"])
+            return collection_response(body, serializer, rows, stream=True)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        page = keyset_page(query, keys, limit, after, before, descending)
+        body.add_control_pagination(
+            "api.scorecollection", page, limit,
+            player_id=player_id, course_id=course_id, order=order, expand=",".join(expand) or None,
+            fields=request.args.get("fields"), **{"from": date_from, "to": date_to}
+        )
+
+        return collection_response(body, serializer, page.rows)
 
+    @query_budget(10)
     def post(self):
         if not request.json:
             return create_error_response(
@@ -62,8 +127,9 @@ class ScoreCollection(Resource):
             )
 
         try:
-            validate(request.json, Score.get_schema())
-        except ValidationError as e:
+            validate_json(request.json, Score)
+            played = parse_date(request.json["date"])
+        except (ValidationError, ValueError) as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
         player = Player.query.filter_by(id=request.json["player_id"]).first()
@@ -82,7 +148,7 @@ class ScoreCollection(Resource):
 
         score = Score(
             throws=request.json["throws"],
-            date=request.json["date"],
+            date=played,
             player_id=request.json["player_id"],
             course_id=request.json["course_id"],
             course=course,
@@ -90,24 +156,215 @@ class ScoreCollection(Resource):
         )
 
         db.session.add(score)
+        db.session.flush()
+        leaderboard.score_changed(score.course_id, score.throws)
+        changes.record(Score, score.id, changes.CREATE)
+        events.publish(events.CREATED, [(score.id, score.throws, score.date, score.player_id, score.course_id)])
+        touch(Score)
         db.session.commit()
 
-
         return Response(status=201, headers={
             "Location": url_for("api.scoreitem", score_id=score.id)
         })
 
+# Server-sent events of created, updated and deleted scores. Each open
+# stream holds a server thread, so a worker process accepts at most
+# LIVE_MAX_SUBSCRIBERS streams and refuses more with 503. The whole server
+# serves SERVER_WORKERS * LIVE_MAX_SUBSCRIBERS streams, raise SERVER_THREADS
+# and LIVE_MAX_SUBSCRIBERS together for more.
+class ScoreStream(Resource):
+
+    @query_budget(1)
+    def get(self):
+        try:
+            player_id = get_int_arg("player_id")
+            course_id = get_int_arg("course_id")
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        filters = {}
+        if player_id is not None:
+            filters["player_id"] = player_id
+        if course_id is not None:
+            filters["course_id"] = course_id
+        hub = events.get_hub()
+        heartbeat = current_app.config["LIVE_HEARTBEAT"]
+        subscription = hub.subscribe(**filters)
+        if subscription is None:
+            response = create_error_response(
+                503, "Too many live streams",
+                "The server has no room for more live streams, try again later"
+            )
+            response.headers["Retry-After"] = str(max(int(heartbeat), 1))
+            return response
+
+        def generate():
+            # The comment sent first tells the client it is subscribed
+            yield ": subscribed\n\n"
+            while True:
+                pending, dropped = subscription.pop_all(heartbeat)
+                if dropped:
+                    yield events.format_event("overflow", {"dropped": dropped})
+                for event, data in pending:
+                    yield events.format_event(event, data)
+                if not pending and not dropped:
+                    yield ": keep-alive\n\n"
+
+        # The subscription lives as long as the response is being read
+        response = Response(generate(), 200, mimetype="text/event-stream", headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        })
+        response.call_on_close(lambda: hub.unsubscribe(subscription))
+        return response
+
+class ScoreBulk(Resource):
+
+    @query_budget(9)
+    def post(self):
+        if request.json is None:
+            return create_error_response(
+                415, "Unsupported media type",
+                "Requests must be JSON"
+            )
+
+        if not isinstance(request.json, list):
+            return create_error_response(
+                400, "Invalid JSON document",
+                "Request body must be an array of scores"
+            )
+
+        if len(request.json) > current_app.config["BULK_MAX_ITEMS"]:
+            return create_error_response(
+                413, "Too many scores",
+                "At most {} scores can be added at once".format(current_app.config["BULK_MAX_ITEMS"])
+            )
+
+        # Results are reported per item, in the order of the request
+        results = [None] * len(request.json)
+        valid = []
+        for index, doc in enumerate(request.json):
+            try:
+                validate_json(doc, Score)
+                valid.append((index, doc, parse_date(doc["date"])))
+            except (ValidationError, ValueError) as e:
+                results[index] = _bulk_error(400, "Invalid JSON document", str(e))
+
+        # Resolve every referenced player and course with one query each
+        player_ids = {doc["player_id"] for _, doc, _ in valid}
+        course_ids = {doc["course_id"] for _, doc, _ in valid}
+        players = {row.id for row in db.session.query(Player.id).filter(Player.id.in_(player_ids))}
+        courses = {row.id for row in db.session.query(Course.id).filter(Course.id.in_(course_ids))}
+
+        indexes = []
+        rows = []
+        for index, doc, played in valid:
+            if doc["player_id"] not in players:
+                results[index] = _bulk_error(
+                    404, "Not found",
+                    "No player found with the id {}".format(doc["player_id"])
+                )
+            elif doc["course_id"] not in courses:
+                results[index] = _bulk_error(
+                    404, "Not found",
+                    "No course found with the id {}".format(doc["course_id"])
+                )
+            else:
+                indexes.append(index)
+                rows.append({
+                    "throws": doc["throws"],
+                    "date": played,
+                    "player_id": doc["player_id"],
+                    "course_id": doc["course_id"],
+                })
+
+        # One executemany and one commit for the whole batch. Returning the
+        # IDs in parameter order would make SQLite insert the rows one at a
+        # time, so the returned rows are matched to the request by content
+        # instead; identical rows are interchangeable. SQLAlchemy would split
+        # the insert into pages of 1000 rows, a page of BULK_MAX_ITEMS keeps
+        # the whole batch in one statement. Inserting into the table skips the
+        # per-row bookkeeping of the ORM bulk insert.
+        if rows:
+            try:
+                returned = db.session.execute(
+                    insert(Score.__table__).returning(Score.id, Score.throws, Score.date, Score.player_id, Score.course_id),
+                    rows,
+                    execution_options={"insertmanyvalues_page_size": current_app.config["BULK_MAX_ITEMS"]}
+                ).all()
+                ids = {}
+                for score_id, *key in sorted(returned):
+                    ids.setdefault(tuple(key), []).append(score_id)
+                inserted = [
+                    ids[(row["throws"], row["date"], row["player_id"], row["course_id"])].pop(0)
+                    for row in rows
+                ]
+                best = {}
+                for row in rows:
+                    best[row["course_id"]] = min(row["throws"], best.get(row["course_id"], row["throws"]))
+                leaderboard.scores_added(best)
+                changes.record(Score, inserted, changes.CREATE)
+                events.publish(events.CREATED, [
+                    (score_id, row["throws"], row["date"], row["player_id"], row["course_id"])
+                    for score_id, row in zip(inserted, rows)
+                ])
+                touch(Score)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                return create_error_response(
+                    409, "Conflict",
+                    "Referenced players or courses were removed while adding the scores"
+                )
+
+            # Resolve the item URL once instead of calling url_for per score
+            prefix, suffix = url_for(
+                "api.scoreitem", score_id=ItemSerializer.PLACEHOLDER
+            ).split(ItemSerializer.PLACEHOLDER)
+            for index, score_id in zip(indexes, inserted):
+                item = MasonBuilder(status=201, score_id=score_id)
+                item.add_control("self", prefix + str(score_id) + suffix)
+                results[index] = item
+
+        body = FrolftrackerBuilder()
+        body.add_namespace("frolf", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.scorebulk"))
+        body.add_control("collection", url_for("api.scorecollection"))
+        body["items"] = results
+
+        return mason_response(body)
+
+def _bulk_error(status_code, title, message):
+    item = MasonBuilder(status=status_code)
+    item.add_error(title, message)
+    return item
+
 class ScoreItem(Resource):
 
+    @query_budget(2)
+    @cached_get(Score, depends=_expanded_models)
     def get(self, score_id):
-        db_score = Score.query.filter_by(id=score_id).first()
+        try:
+            expand = _get_expand()
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        # Expanded relationships are loaded in the same query with a join
+        query = Score.query
+        for name in expand:
+            query = query.options(joinedload(getattr(Score, name)))
+        db_score = query.filter_by(id=score_id).first()
         if db_score is None:
             return create_error_response(
                 404, "Not found",
                 "No score found with the id {}".format(score_id)
             )
 
-        body = FrolftrackerBuilder(score_id=db_score.id, throws=db_score.throws, date=db_score.date, player_id=db_score.player_id, course_id=db_score.course_id)
+        body = FrolftrackerBuilder(score_id=db_score.id, throws=db_score.throws, date=db_score.date.isoformat(), player_id=db_score.player_id, course_id=db_score.course_id)
+        if "player" in expand:
+            body["player_name"] = db_score.player.name
+        if "course" in expand:
+            body["course_name"] = db_score.course.name
         body.add_namespace("frolf", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.scoreitem", score_id=score_id))
         body.add_control("profile", SCORE_PROFILE)
@@ -117,9 +374,10 @@ class ScoreItem(Resource):
         body.add_control_delete_score(score_id)
         body.add_control_modify_score(score_id)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
 
 
+    @query_budget(13)
     def put(self, score_id):
         if not request.json:
             return create_error_response(
@@ -134,8 +392,9 @@ class ScoreItem(Resource):
             )
 
         try:
-            validate(request.json, Score.get_schema())
-        except ValidationError as e:
+            validate_json(request.json, Score)
+            played = parse_date(request.json["date"])
+        except (ValidationError, ValueError) as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
         player = Player.query.filter_by(id=request.json["player_id"]).first()
@@ -152,17 +411,28 @@ class ScoreItem(Resource):
                 "No course found with the id {}".format(request.json["course_id"])
             )
 
+        old_course_id = db_score.course_id
         db_score.throws = request.json["throws"]
-        db_score.date = request.json["date"]
+        db_score.date = played
         db_score.player_id = request.json["player_id"]
         db_score.course_id = request.json["course_id"]
         db_score.course = course
         db_score.player = player
 
+        db.session.flush()
+        if old_course_id != db_score.course_id:
+            leaderboard.score_changed(old_course_id, db_score.throws, score_id=db_score.id)
+        leaderboard.score_changed(db_score.course_id, db_score.throws, score_id=db_score.id)
+        changes.record(Score, db_score.id, changes.UPDATE)
+        events.publish(events.UPDATED, [
+            (db_score.id, db_score.throws, db_score.date, db_score.player_id, db_score.course_id)
+        ])
+        touch(Score)
         db.session.commit()
 
         return Response(status=204)
 
+    @query_budget(8)
     def delete(self, score_id):
         db_score = Score.query.filter_by(id=score_id).first()
         if db_score is None:
@@ -172,6 +442,13 @@ class ScoreItem(Resource):
             )
 
         db.session.delete(db_score)
+        db.session.flush()
+        leaderboard.score_changed(db_score.course_id, db_score.throws)
+        changes.record(Score, db_score.id, changes.DELETE)
+        events.publish(events.DELETED, [
+            (db_score.id, db_score.throws, db_score.date, db_score.player_id, db_score.course_id)
+        ])
+        touch(Score)
         db.session.commit()
 
         return Response(status=204)
@@ -1,8 +1,25 @@
 import json
-from flask import Response, request, url_for
+import re
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
+from flask import Request, Response, current_app, request, stream_with_context, url_for
+from jsonschema import Draft7Validator
+from jsonschema.exceptions import best_match
+from sqlalchemy import tuple_
 from frolftracker.constants import *
 from frolftracker.models import *
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
 # NOTE: MasonBuilder, FrolftrackerBuilder classes and error response function borrowed from PWP exercises
 # https://lovelace.oulu.fi/ohjelmoitava-web/ohjelmoitava-web/implementing-rest-apis-with-flask/
 
@@ -102,6 +119,14 @@ class FrolftrackerBuilder(MasonBuilder):
             schema=Player.get_schema()
         )
 
+    def add_control_get_player_stats(self, player_id):
+        self.add_control(
+            "frolf:stats",
+            url_for("api.playerstats", player_id=player_id),
+            method="GET",
+            title="Statistics of this player"
+        )
+
     def add_control_add_course(self):
         self.add_control(
             "frolf:add-course",
@@ -130,6 +155,14 @@ class FrolftrackerBuilder(MasonBuilder):
             schema=Course.get_schema()
         )
 
+    def add_control_get_leaderboard(self, course_id):
+        self.add_control(
+            "frolf:leaderboard",
+            url_for("api.courseleaderboard", course_id=course_id),
+            method="GET",
+            title="Best rounds on this course"
+        )
+
     def add_control_add_score(self):
         self.add_control(
             "frolf:add-score",
@@ -140,6 +173,16 @@ class FrolftrackerBuilder(MasonBuilder):
             schema=Score.get_schema()
         )
 
+    def add_control_add_scores(self):
+        self.add_control(
+            "frolf:add-scores",
+            url_for("api.scorebulk"),
+            method="POST",
+            encoding="json",
+            title="Add many scores at once",
+            schema=Score.get_bulk_schema()
+        )
+
     def add_control_delete_score(self, score_id):
         self.add_control(
             "frolf:delete",
@@ -174,9 +217,488 @@ class FrolftrackerBuilder(MasonBuilder):
             title="All scores on this course"
         )
 
+    def add_control_pagination(self, endpoint, page, limit, **params):
+        """
+        Adds "next" and "prev" controls for a keyset paginated collection.
+        Extra query parameters (e.g. filters) are carried over to both links.
+
+        : param str endpoint: endpoint name of the collection resource
+        : param Page page: page returned by keyset_page
+        : param int limit: page size requested by the client
+        """
+
+        if page.next_key is not None:
+            self.add_control(
+                "next",
+                url_for(endpoint, after=page.next_key, limit=limit, **params),
+                method="GET",
+                title="Next page"
+            )
+        if page.prev_key is not None:
+            self.add_control(
+                "prev",
+                url_for(endpoint, before=page.prev_key, limit=limit, **params),
+                method="GET",
+                title="Previous page"
+            )
+
+@lru_cache(maxsize=None)
+def get_validator(model):
+    """
+    Returns a JSON schema validator for the schema of *model*. The schema is
+    built and checked against the meta-schema only the first time, after
+    which the same validator is reused by every request.
+    """
+
+    schema = model.get_schema()
+    Draft7Validator.check_schema(schema)
+    return Draft7Validator(schema)
+
+@lru_cache(maxsize=None)
+def get_simple_check(model):
+    """
+    Returns a function that accepts documents of the common shape for the
+    schema of *model* much faster than the validator: an object with the
+    required properties, whose integer and string properties are ints and
+    strs matching their patterns. It only accepts documents the validator
+    accepts too and leaves every other document to it. Returns None if the
+    schema uses keywords the check doesn't know.
+    """
+
+    schema = model.get_schema()
+    if schema.get("type") != "object" or set(schema) - {"type", "required", "properties"}:
+        return None
+    types = {"integer": int, "string": str}
+    properties = {}
+    for name, prop in schema.get("properties", {}).items():
+        if prop.get("type") not in types or set(prop) - {"description", "type", "pattern"}:
+            return None
+        if "pattern" in prop and prop["type"] != "string":
+            return None
+        pattern = re.compile(prop["pattern"]) if "pattern" in prop else None
+        properties[name] = (types[prop["type"]], pattern)
+    required = schema.get("required", [])
+
+    def check(document):
+        if type(document) is not dict:
+            return False
+        for name in required:
+            if name not in document:
+                return False
+        for name, value in document.items():
+            if name in properties:
+                kind, pattern = properties[name]
+                # bool is an int to Python but not an integer to JSON schema
+                if type(value) is not kind:
+                    return False
+                if pattern is not None and pattern.search(value) is None:
+                    return False
+        return True
+
+    return check
+
+def validate_json(document, model):
+    """
+    Validates *document* against the schema of *model* with a cached
+    validator. Raises ValidationError for the most relevant error, exactly
+    like jsonschema.validate would.
+    """
+
+    check = get_simple_check(model)
+    if check is not None and check(document):
+        return
+    error = best_match(get_validator(model).iter_errors(document))
+    if error is not None:
+        raise error
+
+class ItemSerializer(object):
+    """
+    Serializer for the items of a collection. Produces the same documents
+    as building each item with FrolftrackerBuilder, adding its "self" and
+    "profile" controls, but works on plain tuple rows and resolves the item
+    URL template once per request instead of calling url_for for every item.
+
+    Fields are given as (name, column) or (name, column, convert) tuples,
+    where *convert* turns the column value into a JSON compatible value.
+
+    In compact mode the items are plain arrays of the item ID followed by
+    the other field values, in the order of compact_names, without controls.
+    """
+
+    PLACEHOLDER = "__item_id__"
+
+    def __init__(self, endpoint, id_arg, id_column, profile, *fields):
+        self.endpoint = endpoint
+        self.id_arg = id_arg
+        self.profile = profile
+        self.field_specs = fields
+        self.columns = [id_column]
+        self.fields = []
+        for field in fields:
+            name, column = field[:2]
+            convert = field[2] if len(field) > 2 else None
+            if column not in self.columns:
+                self.columns.append(column)
+            self.fields.append((name, self.columns.index(column), convert))
+        self.names = [field[0] for field in fields]
+        self.compact_names = [id_arg] + [name for name in self.names if name != id_arg]
+
+    def extend(self, *fields):
+        """
+        Returns a serializer that adds *fields* after the fields of this one,
+        e.g. columns of joined tables.
+        """
+
+        return ItemSerializer(
+            self.endpoint, self.id_arg, self.columns[0], self.profile,
+            *(self.field_specs + fields)
+        )
+
+    def only(self, names):
+        """
+        Returns a serializer with only the fields in *names*, e.g. the sparse
+        fieldset requested with "?fields=". The "self" control of the items
+        is kept. Raises ValueError for unknown field names.
+        """
+
+        for name in names:
+            if name not in self.names:
+                raise ValueError("Query parameter 'fields' must be a list of {}".format(", ".join(self.names)))
+        return ItemSerializer(
+            self.endpoint, self.id_arg, self.columns[0], self.profile,
+            *[field for field in self.field_specs if field[0] in names]
+        )
+
+    def select(self, query, *extra):
+        """
+        Restricts *query* to the columns the serializer needs, in the order
+        it expects them, followed by the *extra* columns it doesn't have,
+        e.g. the keys of a keyset paginated query.
+        """
+
+        return query.with_entities(*self.columns, *[column for column in extra if column not in self.columns])
+
+    def bind(self, compact=False):
+        """
+        Resolves the URL template of the items for the current request and
+        returns a function that serializes one row into an item document,
+        or into an array of values if *compact* is set.
+        """
+
+        fields = self.fields
+
+        if compact:
+            values = [field for field in fields if field[0] != self.id_arg]
+
+            def serialize_compact(row):
+                return [row[0]] + [
+                    convert(row[index]) if convert is not None else row[index]
+                    for _, index, convert in values
+                ]
+
+            return serialize_compact
+
+        prefix, suffix = url_for(
+            self.endpoint, **{self.id_arg: self.PLACEHOLDER}
+        ).split(self.PLACEHOLDER)
+        profile = {"href": self.profile}
+
+        def serialize(row):
+            item = {}
+            for name, index, convert in fields:
+                value = row[index]
+                item[name] = convert(value) if convert is not None else value
+            item["@controls"] = {
+                "self": {"href": prefix + str(row[0]) + suffix},
+                "profile": profile
+            }
+            return item
+
+        return serialize
+
+Page = namedtuple("Page", ["rows", "next_key", "prev_key"])
+
+def get_int_arg(name, default=None, minimum=0):
+    """
+    Reads an integer query parameter. Returns *default* if the parameter is
+    missing and raises ValueError if it's not an integer >= *minimum*.
+    """
+
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError("Query parameter '{}' must be an integer".format(name))
+    if value < minimum:
+        raise ValueError("Query parameter '{}' must be at least {}".format(name, minimum))
+    return value
+
+def get_date_arg(name):
+    """
+    Reads a date query parameter in YYYY-MM-DD format. Returns None if the
+    parameter is missing and raises ValueError if it's not a valid date.
+    """
+
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return parse_date(value)
+    except ValueError:
+        raise ValueError("Query parameter '{}' must be a date in YYYY-MM-DD format".format(name))
+
+def parse_date(value):
+    """
+    Converts a YYYY-MM-DD string into a date. Raises ValueError for strings
+    in any other format and for dates that don't exist.
+    """
+
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+def get_limit_arg():
+    """
+    Reads the page size parameter "limit" from the query string. It
+    defaults to PAGE_SIZE from the app config, and values over
+    MAX_PAGE_SIZE raise ValueError like other invalid values.
+    """
+
+    limit = get_int_arg("limit", current_app.config["PAGE_SIZE"], minimum=1)
+    if limit > current_app.config["MAX_PAGE_SIZE"]:
+        raise ValueError("Query parameter 'limit' must be at most {}".format(
+            current_app.config["MAX_PAGE_SIZE"]
+        ))
+    return limit
+
+def get_page_args(parse_cursor=int):
+    """
+    Reads the keyset pagination parameters "limit", "after" and "before" from
+    the query string, see get_limit_arg for the page size. Cursors are
+    converted with *parse_cursor*. Raises ValueError for invalid values.
+    """
+
+    limit = get_limit_arg()
+    cursors = []
+    for name in ("after", "before"):
+        value = request.args.get(name)
+        if value is not None:
+            try:
+                value = parse_cursor(value)
+            except ValueError:
+                raise ValueError("Query parameter '{}' is not a valid cursor".format(name))
+        cursors.append(value)
+    after, before = cursors
+    if after is not None and before is not None:
+        raise ValueError("Query parameters 'after' and 'before' are mutually exclusive")
+    return limit, after, before
+
+def order_by_keys(query, keys, descending=False):
+    """
+    Orders *query* by the sequence of key columns in *keys*.
+    """
+
+    return query.order_by(*[key.desc() if descending else key.asc() for key in keys])
+
+def keyset_page(query, key, limit, after=None, before=None, descending=False):
+    """
+    Fetches one page of *query* using keyset pagination on the *key* column
+    (normally the primary key). Instead of an OFFSET scan, every page starts
+    with an index seek to the key of the previous page boundary, so the cost
+    of a page doesn't depend on how deep into the collection it is.
+
+    *key* can also be a tuple of columns ending with a unique one, e.g.
+    (Score.date, Score.id). The cursors are then tuples of values, and the
+    cursors of the returned page are the values joined with commas.
+
+    Fetches one extra row to find out whether there's a following page.
+    Returns a Page whose next_key and prev_key are None when there's no
+    page in that direction.
+    """
+
+    keys = key if isinstance(key, tuple) else (key,)
+    column = tuple_(*keys) if len(keys) > 1 else keys[0]
+
+    def cursor_of(row):
+        values = [getattr(row, k.key) for k in keys]
+        if len(values) == 1:
+            return values[0]
+        return ",".join(str(value) for value in values)
+
+    def bound(cursor):
+        return tuple_(*cursor) if len(keys) > 1 else cursor
+
+    if before is not None:
+        condition = column > bound(before) if descending else column < bound(before)
+        query = order_by_keys(query.filter(condition), keys, not descending)
+        rows = query.limit(limit + 1).all()
+        more = len(rows) > limit
+        rows = rows[:limit][::-1]
+        next_key = cursor_of(rows[-1]) if rows else None
+        prev_key = cursor_of(rows[0]) if more else None
+    else:
+        if after is not None:
+            condition = column < bound(after) if descending else column > bound(after)
+            query = query.filter(condition)
+        rows = order_by_keys(query, keys, descending).limit(limit + 1).all()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        next_key = cursor_of(rows[-1]) if more else None
+        prev_key = cursor_of(rows[0]) if after is not None and rows else None
+
+    return Page(rows, next_key, prev_key)
+
+# Encoder and decoder of each supported format by media type suffix. The
+# binary formats are only offered when their library is installed.
+FORMATS = {"json": (json.dumps, json.loads)}
+if msgpack is not None:
+    FORMATS["msgpack"] = (msgpack.packb, msgpack.unpackb)
+if cbor2 is not None:
+    FORMATS["cbor"] = (cbor2.dumps, cbor2.loads)
+
+def _with_suffix(media_type, suffix):
+    return media_type.rsplit("+", 1)[0] + "+" + suffix
+
+# Supported media types mapped to (compact, format suffix), in order of
+# preference when the Accept header allows several of them
+MEDIA_TYPES = {}
+for _suffix in FORMATS:
+    MEDIA_TYPES[_with_suffix(MASON, _suffix)] = (False, _suffix)
+for _suffix in FORMATS:
+    MEDIA_TYPES[_with_suffix(COMPACT, _suffix)] = (True, _suffix)
+for _suffix in FORMATS:
+    MEDIA_TYPES["application/" + _suffix] = (False, _suffix)
+
+def get_media_type():
+    """
+    Returns the media type of the representation requested with the Accept
+    header, one of MEDIA_TYPES. Defaults to MASON.
+    """
+
+    return request.accept_mimetypes.best_match(MEDIA_TYPES, MASON)
+
+def mason_response(body, status_code=200, headers=None):
+    """
+    Creates the response of a Mason document, encoded in the format
+    negotiated with the Accept header. Resources should create their
+    responses with this instead of encoding the document themselves.
+    """
+
+    media_type = get_media_type()
+    compact, suffix = MEDIA_TYPES[media_type]
+    if compact:
+        # Only collections have a compact representation
+        media_type = _with_suffix(MASON, suffix)
+    return Response(FORMATS[suffix][0](body), status_code, headers=headers, mimetype=media_type)
+
+class MasonRequest(Request):
+    """
+    Request class of the app. Decodes the request body of every supported
+    format, so request.json is the document whether it was sent as JSON or
+    in one of the binary formats.
+    """
+
+    def get_json(self, force=False, silent=False, cache=True):
+        media = MEDIA_TYPES.get(self.mimetype)
+        if media is None or media[1] == "json":
+            return super().get_json(force=force, silent=silent, cache=cache)
+
+        if cache and getattr(self, "_decoded_body", None) is not None:
+            return self._decoded_body
+        try:
+            document = FORMATS[media[1]][1](self.get_data(cache=cache))
+        except Exception as e:
+            if silent:
+                return None
+            return self.on_json_loading_failed(e)
+        if cache:
+            self._decoded_body = document
+        return document
+
+def get_fields_arg(serializer):
+    """
+    Returns *serializer* restricted to the fields listed in the "fields"
+    query parameter, if given. Raises ValueError for unknown fields.
+    """
+
+    value = request.args.get("fields")
+    if not value:
+        return serializer
+    return serializer.only(value.split(","))
+
+def wants_stream():
+    """
+    Returns True if the client asked for the whole collection to be streamed
+    with the "stream" query parameter instead of getting it one page at a time.
+    """
+
+    return request.args.get("stream", "").lower() in ("1", "true", "yes")
+
+def stream_collection_response(body, items, mimetype=MASON):
+    """
+    Creates a streaming response for a Mason collection document. The
+    envelope in *body* is written first and *items* are then serialized one
+    at a time as the WSGI server consumes the response, so memory use stays
+    flat and the first bytes go out before the query has been exhausted.
+    The output is identical to json.dumps of the fully built document.
+
+    : param FrolftrackerBuilder body: collection document without items
+    : param iterable items: item documents, e.g. a generator over yield_per
+    """
+
+    body["items"] = []
+    head = json.dumps(body)
+    # "items" is the last key so the document ends with its empty list
+    prefix, suffix = head[:-len("]}")], head[-len("]}"):]
+
+    def generate():
+        yield prefix
+        separator = ""
+        for item in items:
+            yield separator + json.dumps(item)
+            separator = ", "
+        yield suffix
+
+    return Response(stream_with_context(generate()), 200, mimetype=mimetype)
+
+def collection_response(body, serializer, rows, stream=False):
+    """
+    Creates the response of a collection from the collection document in
+    *body* and the rows of its items.
+
+    The document is encoded in the format negotiated with the Accept header.
+    With the COMPACT media types the controls are left out: the document only
+    has the names of the item ID and fields, the hrefs of the next and previous pages and the
+    items as arrays of values.
+
+    : param FrolftrackerBuilder body: collection document without items
+    : param ItemSerializer serializer: serializer of the items
+    : param iterable rows: item rows selected with the serializer
+    : param bool stream: whether to stream the response
+    """
+
+    mimetype = get_media_type()
+    compact, suffix = MEDIA_TYPES[mimetype]
+    serialize = serializer.bind(compact)
+    if compact:
+        controls = body.get("@controls", {})
+        body = {
+            "fields": serializer.compact_names,
+            "next": controls.get("next", {}).get("href"),
+            "prev": controls.get("prev", {}).get("href"),
+        }
+
+    items = (serialize(row) for row in rows)
+    if stream and suffix == "json":
+        return stream_collection_response(body, items, mimetype)
+    # The binary formats need the length of the item array up front, so
+    # their streamed collections are built in memory
+    body["items"] = list(items)
+    return Response(FORMATS[suffix][0](body), 200, mimetype=mimetype)
+
 def create_error_response(status_code, title, message=None):
     resource_url = request.path
     body = MasonBuilder(resource_url=resource_url)
     body.add_error(title, message)
     body.add_control("profile", href=ERROR_PROFILE)
-    return Response(json.dumps(body), status_code, mimetype=MASON)
+    return mason_response(body, status_code)
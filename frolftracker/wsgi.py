@@ -0,0 +1,9 @@
+"""
+WSGI entry point for production servers. Serve the API with
+
+    gunicorn -c gunicorn.conf.py frolftracker.wsgi:app
+"""
+
+from frolftracker import create_app
+
+app = create_app()
@@ -0,0 +1,63 @@
+# Gunicorn configuration for serving the API in production:
+#
+#     gunicorn -c gunicorn.conf.py frolftracker.wsgi:app
+#
+# The app is created once in the master process before the workers are
+# forked, and the server settings are read from its config (the SERVER_*
+# keys, see create_app). Command line options override them.
+
+import glob
+import os
+import shutil
+import tempfile
+
+from frolftracker import db, metrics
+from frolftracker.wsgi import app
+
+bind = app.config["SERVER_BIND"]
+workers = app.config["SERVER_WORKERS"]
+threads = app.config["SERVER_THREADS"]
+# Live score streams hold a thread each for as long as they are open
+if app.config["LIVE_MAX_SUBSCRIBERS"] >= threads:
+    raise RuntimeError("LIVE_MAX_SUBSCRIBERS must be lower than SERVER_THREADS")
+worker_class = "gthread"
+preload_app = True
+
+# Workers are replaced after a number of requests, jittered so that they
+# don't all restart at once
+max_requests = app.config["SERVER_MAX_REQUESTS"]
+max_requests_jitter = app.config["SERVER_MAX_REQUESTS_JITTER"]
+
+# On SIGTERM workers finish the requests in progress for up to
+# graceful_timeout seconds before they are killed
+timeout = app.config["SERVER_TIMEOUT"]
+graceful_timeout = app.config["SERVER_GRACEFUL_TIMEOUT"]
+keepalive = 5
+
+accesslog = "-"
+
+def post_fork(server, worker):
+    # Database connections opened in the master must not be used by the
+    # workers, each of them gets a fresh pool
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+# Every worker writes its metrics to a file in this directory and /metrics
+# adds them up, so each scrape sees the totals of the whole server
+metrics_dir = app.config["METRICS_DIR"] or tempfile.mkdtemp(prefix="frolftracker-metrics-")
+app.extensions["metrics"].directory = metrics_dir
+
+def on_starting(server):
+    # Files left over from an earlier run would be counted again
+    for path in glob.glob(os.path.join(metrics_dir, "*.json")):
+        os.unlink(path)
+
+def worker_exit(server, worker):
+    app.extensions["metrics"].flush()
+
+def child_exit(server, worker):
+    metrics.mark_process_dead(metrics_dir, worker.pid)
+
+def on_exit(server):
+    if not app.config["METRICS_DIR"]:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
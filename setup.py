@@ -9,9 +9,12 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=[
-        "flask",
+        "flask>=2.2",
         "flask-restful",
-        "flask-sqlalchemy",
-        "SQLAlchemy",
-    ]
+        "flask-sqlalchemy>=3.0",
+        "SQLAlchemy>=2.0",
+    ],
+    extras_require={
+        "binary": ["msgpack", "cbor2"],
+    }
 )
@@ -4,8 +4,10 @@ import tempfile
 
 from datetime import date
 
+from sqlalchemy import text
+
 from frolftracker import create_app, db
-from frolftracker.models import Player, Course, Score
+from frolftracker.models import Player, Course, LeaderboardEntry, Score, get_versions
 
 
 # Foreign keys ON
@@ -37,6 +39,9 @@ def app():
         
     yield app
     
+    # Closing the pooled connections removes the WAL files
+    with app.app_context():
+        db.engine.dispose()
     os.close(db_fd)
     os.unlink(db_fname)
 
@@ -84,3 +89,121 @@ def test_create_course(app):
         db.session.add(course)
         db.session.commit()
         assert Course.query.count() == 1
+
+def _get_index_names():
+    rows = db.session.execute(
+        text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'score'")
+    )
+    return {row[0] for row in rows}
+
+def test_upgrade_db_adds_indexes(app):
+    with app.app_context():
+        db.session.execute(text("DROP INDEX ix_score_player_course_date"))
+        db.session.execute(text("DROP INDEX ix_score_course_throws"))
+        db.session.commit()
+        assert "ix_score_course_throws" not in _get_index_names()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["upgrade-db"])
+    assert result.exit_code == 0
+    # running it again must not fail on the existing indexes
+    result = runner.invoke(args=["upgrade-db"])
+    assert result.exit_code == 0
+
+    with app.app_context():
+        names = _get_index_names()
+        assert "ix_score_player_course_date" in names
+        assert "ix_score_course_throws" in names
+
+def test_upgrade_db_normalizes_dates(app):
+    with app.app_context():
+        score = _get_score()
+        db.session.add(score)
+        db.session.commit()
+        db.session.execute(text("UPDATE score SET date = '2020-06-22 18:30'"))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["upgrade-db"])
+    assert result.exit_code == 0
+
+    with app.app_context():
+        assert Score.query.first().date == date(2020, 6, 22)
+
+def test_load_data_generates_rows(app):
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=[
+        "load-data", "--players", "20", "--courses", "3", "--scores", "500", "--seed", "1", "--batch-size", "64"
+    ])
+    assert result.exit_code == 0, result.output
+
+    with app.app_context():
+        assert Player.query.count() == 20
+        assert Course.query.count() == 3
+        assert Score.query.count() == 500
+        assert "ix_score_course_throws" in _get_index_names()
+        # leaderboards are built from the loaded scores
+        best = Score.query.filter_by(course_id=1).order_by(Score.throws).first()
+        entry = LeaderboardEntry.query.filter_by(course_id=1).order_by(LeaderboardEntry.throws).first()
+        assert entry.throws == best.throws
+        assert get_versions(Score) == (1,)
+
+    # loading again adds new courses instead of failing on their names
+    result = runner.invoke(args=["load-data", "--courses", "3", "--keep-indexes"])
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        assert Course.query.count() == 6
+
+def test_load_data_from_csv(app, tmp_path):
+    (tmp_path / "players.csv").write_text("name\nalice\nbob\n")
+    (tmp_path / "courses.csv").write_text("name,num_holes,par\nkeskuspuisto,18,54\n")
+    (tmp_path / "scores.csv").write_text("throws,date,player_id,course_id\n55,2020-06-22,2,1\n")
+
+    result = app.test_cli_runner().invoke(args=["load-data", "--csv-dir", str(tmp_path)])
+    assert result.exit_code == 0, result.output
+
+    with app.app_context():
+        assert [player.name for player in Player.query.order_by(Player.id)] == ["alice", "bob"]
+        course = Course.query.one()
+        assert (course.num_holes, course.par) == (18, 54)
+        score = Score.query.one()
+        assert (score.throws, score.date, score.player.name) == (55, date(2020, 6, 22), "bob")
+
+def test_in_memory_database():
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "TESTING": True})
+    with app.app_context():
+        db.create_all()
+        db.session.add(_get_player())
+        db.session.commit()
+        assert Player.query.count() == 1
+
+def test_upgrade_db_reports_invalid_dates(app):
+    with app.app_context():
+        score = _get_score()
+        db.session.add(score)
+        db.session.commit()
+        db.session.execute(text("UPDATE score SET date = '2020-02-30 12:00'"))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["upgrade-db"])
+    assert result.exit_code != 0
+    assert "score 1: 2020-02-30" in result.output
+
+    with app.app_context():
+        # nothing was changed
+        played = db.session.execute(text("SELECT date FROM score")).scalar()
+        assert played == "2020-02-30 12:00"
+
+def test_upgrade_db_recreates_live_events(app):
+    with app.app_context():
+        db.session.execute(text("DROP TABLE live_event"))
+        db.session.execute(text("CREATE TABLE live_event (id INTEGER PRIMARY KEY, event VARCHAR)"))
+        db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=["upgrade-db"])
+    assert result.exit_code == 0, result.output
+
+    with app.app_context():
+        sql = db.session.execute(
+            text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'live_event'")
+        ).scalar()
+        assert "AUTOINCREMENT" in sql
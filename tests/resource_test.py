@@ -2,19 +2,29 @@
 # https://lovelace.oulu.fi/ohjelmoitava-web/ohjelmoitava-web/testing-flask-applications-part-2/
 # https://lovelace.oulu.fi/ohjelmoitava-web/ohjelmoitava-web/flask-api-project-layout/
 
+import gzip
 import json
 import os
 import pytest
+import statistics
 import tempfile
 import time
 from datetime import date
-from jsonschema import validate
+from jsonschema import validate, ValidationError
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy import event, update
 from sqlalchemy.exc import IntegrityError, StatementError
 
-from frolftracker import create_app, db
-from frolftracker.models import Player, Score, Course
+from frolftracker import api, create_app, db
+from frolftracker.models import LiveEvent, Player, Score, Course, load_data
+from flask import url_for
+
+from frolftracker.constants import COMPACT, COURSE_PROFILE, MASON, PLAYER_PROFILE, SCORE_PROFILE
+from frolftracker.resources.course import COURSE_ITEM
+from frolftracker.metrics import mark_process_dead, query_budget
+from frolftracker.resources.player import PLAYER_ITEM, PlayerCollection
+from frolftracker.resources.score import SCORE_ITEM
+from frolftracker.utils import FrolftrackerBuilder, get_simple_check, get_validator, validate_json
 
 
 @event.listens_for(Engine, "connect")
@@ -30,7 +40,8 @@ def client():
     db_fd, db_fname = tempfile.mkstemp()
     config = {
         "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
-        "TESTING": True
+        "TESTING": True,
+        "QUERY_BUDGET_MODE": "error"
     }
     
     app = create_app(config)
@@ -41,6 +52,9 @@ def client():
         
     yield app.test_client()
     
+    # Closing the pooled connections removes the WAL files
+    with app.app_context():
+        db.engine.dispose()
     os.close(db_fd)
     os.unlink(db_fname)
 
@@ -100,6 +114,71 @@ def _get_score_json(number=1):
             "player_id": number, 
             "course_id": number}
 
+def _get_query_plans(client, method, url, table="score"):
+    """
+    Sends a request and returns the SQLite query plan of every statement the
+    request executed against the given table as (statement, details) pairs.
+    """
+
+    app = client.application
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if table in statement and not statement.lstrip().upper().startswith("INSERT"):
+            statements.append((statement, parameters[0] if executemany else parameters))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        getattr(client, method)(url)
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+    plans = []
+    with app.app_context():
+        connection = db.engine.raw_connection()
+        cursor = connection.cursor()
+        for statement, parameters in statements:
+            rows = cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+            plans.append((statement, [row[-1] for row in rows]))
+        connection.close()
+    return plans
+
+def _check_no_full_scan(plans, table="score", sort=True):
+    """
+    Checks that none of the query plans scans the whole given table. With
+    *sort* set to False the plans must not sort the rows either, so that the
+    index also serves the order of the page.
+    """
+
+    assert plans
+    for statement, details in plans:
+        for detail in details:
+            assert not detail.startswith("SCAN " + table), statement
+            assert sort or not detail.startswith("USE TEMP B-TREE FOR ORDER BY"), statement
+
+def _count_statements(client, method, url):
+    """
+    Sends a request and returns the SQL statements it executed, leaving out
+    the read of the table version counters.
+    """
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if "table_version" not in statement:
+            statements.append(statement)
+
+    with client.application.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        resp = getattr(client, method)(url)
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+    return resp, statements
+
 def _check_namespace(client, response):
     """
     Checks that the "frolf" namespace is found from the response body, and
@@ -302,6 +381,37 @@ class TestPlayerCollection(object):
             _check_control_get_method("profile", client, item)
             assert "name" in item
 
+    def test_get_paginated(self, client):
+        """
+        Tests keyset pagination of the collection. Walks the collection
+        forward with "next" controls and back with "prev" controls, and checks
+        that invalid pagination parameters result in 400.
+        """
+
+        resp = client.get(self.RESOURCE_URL, query_string={"limit": 3})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == [
+            "test-player-0", "test-player-1", "test-player-2"
+        ]
+        assert "prev" not in body["@controls"]
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["name"] for item in body["items"]] == ["test-player-3"]
+        assert "next" not in body["@controls"]
+        resp = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 3
+        assert "prev" not in body["@controls"]
+        assert "next" in body["@controls"]
+
+        resp = client.get(self.RESOURCE_URL, query_string={"limit": 0})
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL, query_string={"after": "x"})
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL, query_string={"after": 1, "before": 3})
+        assert resp.status_code == 400
+
     def test_post(self, client):
         """
         Tests the POST method. Checks all of the possible error codes, and 
@@ -355,6 +465,7 @@ class TestPlayerItem(object):
         _check_control_get_method("profile", client, body)
         _check_control_get_method("collection", client, body)
         _check_control_get_method("frolf:scores-by", client, body)
+        _check_control_get_method("frolf:stats", client, body)
         _check_control_put_method_player("edit", client, body)
         _check_control_delete_method("frolf:delete", client, body)
         resp = client.get(self.INVALID_URL)
@@ -413,6 +524,61 @@ class TestPlayerItem(object):
         resp = client.delete(self.INVALID_URL)
         assert resp.status_code == 404
                 
+class TestPlayerStats(object):
+    """
+    This class implements tests for the player statistics resource.
+    """
+
+    RESOURCE_URL = "/api/players/1/stats/"
+    INVALID_URL = "/api/players/999/stats/"
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Adds rounds on two courses and checks the
+        overall and per course statistics against ones computed in Python,
+        and the controls of the document.
+        """
+
+        for course_id, throws in ((1, 50), (1, 61), (2, 57), (2, 57), (2, 66)):
+            valid = _get_score_json(1)
+            valid["course_id"] = course_id
+            valid["throws"] = throws
+            client.post("/api/scores/", json=valid)
+
+        # the populated rounds of player 1 are 54 and 58, both on course 1
+        course_1 = [54, 58, 50, 61]
+        course_2 = [57, 57, 66]
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        _check_control_get_method("self", client, body)
+        _check_control_get_method("up", client, body)
+        assert body["name"] == "test-player-0"
+        for stats, rounds in ((body, course_1 + course_2), (body["courses"][0], course_1), (body["courses"][1], course_2)):
+            assert stats["count"] == len(rounds)
+            assert stats["mean"] == pytest.approx(statistics.mean(rounds))
+            assert stats["best"] == min(rounds)
+            assert stats["worst"] == max(rounds)
+            assert stats["stddev"] == pytest.approx(statistics.stdev(rounds))
+        assert [course["course_id"] for course in body["courses"]] == [1, 2]
+        assert body["courses"][0]["par"] == 69
+        for course in body["courses"]:
+            _check_control_get_method("frolf:course", client, course)
+            _check_control_get_method("frolf:scores-by", client, course)
+
+        resp = client.get(self.INVALID_URL)
+        assert resp.status_code == 404
+
+    def test_get_without_rounds(self, client):
+        resp = client.post("/api/players/", json=_get_player_json())
+        resp = client.get(resp.headers["Location"] + "stats/")
+        body = json.loads(resp.data)
+        assert body["count"] == 0
+        assert body["mean"] is None
+        assert body["stddev"] is None
+        assert body["courses"] == []
+
 class TestCourseCollection(object):
     """
     This class implements tests for each HTTP method in course collection
@@ -499,6 +665,7 @@ class TestCourseItem(object):
         _check_control_get_method("profile", client, body)
         _check_control_get_method("collection", client, body)
         _check_control_get_method("frolf:scores-by", client, body)
+        _check_control_get_method("frolf:leaderboard", client, body)
         _check_control_put_method_course("edit", client, body)
         _check_control_delete_method("frolf:delete", client, body)
         resp = client.get(self.INVALID_URL)
@@ -558,6 +725,140 @@ class TestCourseItem(object):
         assert resp.status_code == 404
         
         
+class TestCourseLeaderboard(object):
+    """
+    This class implements tests for the course leaderboard resource and the
+    incremental maintenance of the leaderboards.
+    """
+
+    RESOURCE_URL = "/api/courses/1/leaderboard/"
+    INVALID_URL = "/api/courses/999/leaderboard/"
+
+    def _expected(self, client, course_id, size):
+        resp = client.get("/api/scores/", query_string={"course_id": course_id, "stream": 1})
+        scores = json.loads(resp.data)["items"]
+        scores.sort(key=lambda item: (item["throws"], item["date"], item["score_id"]))
+        return [item["score_id"] for item in scores[:size]]
+
+    def _listed(self, client, course_id):
+        resp = client.get("/api/courses/{}/leaderboard/".format(course_id))
+        return [item["score_id"] for item in json.loads(resp.data)["items"]]
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Rebuilds the leaderboards of the populated
+        database, then checks the ranking, the attributes and controls of the
+        items, and that invalid requests get 404 and 400.
+        """
+
+        result = client.application.test_cli_runner().invoke(args=["rebuild-leaderboards"])
+        assert result.exit_code == 0
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        _check_control_get_method("self", client, body)
+        _check_control_get_method("up", client, body)
+        assert body["par"] == 69
+        assert [item["rank"] for item in body["items"]] == [1, 2]
+        assert [item["throws"] for item in body["items"]] == [54, 58]
+        first = body["items"][0]
+        assert first["relative"] == 54 - 69
+        assert first["player_name"] == "test-player-0"
+        _check_control_get_method("self", client, first)
+        _check_control_get_method("frolf:player", client, first)
+
+        resp = client.get(self.INVALID_URL)
+        assert resp.status_code == 404
+        resp = client.get(self.RESOURCE_URL, query_string={"from": "yesterday"})
+        assert resp.status_code == 400
+
+    def test_rebuild_invalidates_cache(self, client):
+        """
+        Checks that rebuilding the leaderboards changes the ETag and isn't
+        answered from the response cache.
+        """
+
+        client.application.test_cli_runner().invoke(args=["rebuild-leaderboards"])
+        with client.application.app_context():
+            db.session.execute(db.text("DELETE FROM leaderboard_entry WHERE course_id = 1"))
+            db.session.commit()
+        resp = client.get(self.RESOURCE_URL)
+        assert json.loads(resp.data)["items"] == []
+        etag = resp.headers["ETag"]
+
+        result = client.application.test_cli_runner().invoke(args=["rebuild-leaderboards"])
+        assert result.exit_code == 0
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.headers["ETag"] != etag
+        assert len(json.loads(resp.data)["items"]) == 2
+
+    def test_incremental(self, client):
+        """
+        Checks that the leaderboards stay equal to the best rounds of each
+        course through additions, bulk additions, edits, deletions and
+        cascading deletions, without rebuilding them.
+        """
+
+        client.application.config["LEADERBOARD_SIZE"] = 3
+        client.application.test_cli_runner().invoke(args=["rebuild-leaderboards"])
+
+        for throws in (70, 50, 60, 50):
+            valid = _get_score_json(1)
+            valid["throws"] = throws
+            client.post("/api/scores/", json=valid)
+        assert self._listed(client, 1) == self._expected(client, 1, 3)
+
+        batch = []
+        for throws in (40, 80):
+            valid = _get_score_json(2)
+            valid["throws"] = throws
+            batch.append(valid)
+        client.post("/api/scores/bulk/", json=batch)
+        assert self._listed(client, 2) == self._expected(client, 2, 3)
+
+        # worsen the best round so it drops off the leaderboard
+        best = self._listed(client, 1)[0]
+        valid = _get_score_json(1)
+        valid["throws"] = 99
+        client.put("/api/scores/{}/".format(best), json=valid)
+        assert best not in self._listed(client, 1)
+        assert self._listed(client, 1) == self._expected(client, 1, 3)
+
+        # move a round to another course
+        moved = self._listed(client, 1)[0]
+        valid = _get_score_json(2)
+        valid["throws"] = 1
+        client.put("/api/scores/{}/".format(moved), json=valid)
+        assert self._listed(client, 1) == self._expected(client, 1, 3)
+        assert self._listed(client, 2)[0] == moved
+
+        client.delete("/api/scores/{}/".format(self._listed(client, 1)[0]))
+        assert self._listed(client, 1) == self._expected(client, 1, 3)
+
+        client.delete("/api/players/1/")
+        for course_id in (1, 2):
+            assert self._listed(client, course_id) == self._expected(client, course_id, 3)
+
+    def test_date_window(self, client):
+        """
+        Checks that a date window ranks only the rounds played within it.
+        """
+
+        for day, throws in ((1, 45), (2, 65), (3, 55)):
+            valid = _get_score_json(1)
+            valid["throws"] = throws
+            valid["date"] = "2019-05-0{}".format(day)
+            client.post("/api/scores/", json=valid)
+
+        resp = client.get(self.RESOURCE_URL, query_string={"from": "2019-05-02", "to": "2019-05-31"})
+        body = json.loads(resp.data)
+        assert [item["throws"] for item in body["items"]] == [55, 65]
+        resp = client.get(self.RESOURCE_URL, query_string={"to": "2019-12-31", "limit": 1})
+        body = json.loads(resp.data)
+        assert [item["throws"] for item in body["items"]] == [45]
+
 class TestScoreCollection(object):
     """
     This class implements tests for each HTTP method in score collection
@@ -592,6 +893,190 @@ class TestScoreCollection(object):
             assert "player_id" in item
             assert "course_id" in item
 
+    def test_get_paginated(self, client):
+        """
+        Tests keyset pagination of scores filtered by player. Checks that the
+        filter is carried over to the "next" control and that following the
+        controls returns every matching score exactly once.
+        """
+
+        seen = []
+        href = self.RESOURCE_URL + "?player_id=1&limit=1"
+        while href:
+            resp = client.get(href)
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            assert len(body["items"]) <= 1
+            for item in body["items"]:
+                assert item["player_id"] == 1
+                seen.append(item["score_id"])
+            href = body["@controls"].get("next", {}).get("href")
+        assert seen == [1, 5]
+
+        resp = client.get(self.RESOURCE_URL, query_string={"player_id": "abc"})
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL, query_string={"limit": 100000})
+        assert resp.status_code == 400
+
+    def test_get_streamed(self, client):
+        """
+        Tests the streaming mode of the GET method. Checks that the response
+        is streamed, that it's the same document as a single page containing
+        all items and that filters are applied.
+        """
+
+        resp = client.get(self.RESOURCE_URL, query_string={"stream": "true"})
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        assert resp.data == client.get(self.RESOURCE_URL).data
+        assert len(json.loads(resp.data)["items"]) == 8
+
+        resp = client.get(self.RESOURCE_URL, query_string={"stream": 1, "course_id": 2})
+        body = json.loads(resp.data)
+        assert [item["score_id"] for item in body["items"]] == [2, 6]
+
+    def test_get_sparse(self, client):
+        """
+        Tests the "fields" parameter. Checks that only the requested fields
+        and the "self" control are included, that the fields are carried over
+        to the "next" control and that unknown fields give 400.
+        """
+
+        resp = client.get(self.RESOURCE_URL + "?fields=throws,date&order=desc&limit=5")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        item = body["items"][0]
+        assert set(item) == {"throws", "date", "@controls"}
+        assert "self" in item["@controls"]
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        assert len(body["items"]) == 3
+        assert set(body["items"][0]) == {"throws", "date", "@controls"}
+
+        resp = client.get(self.RESOURCE_URL + "?fields=player_id,player_name&expand=player")
+        assert json.loads(resp.data)["items"][0]["player_name"] == "test-player-0"
+        resp = client.get(self.RESOURCE_URL + "?fields=player_name")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?fields=password")
+        assert resp.status_code == 400
+
+    def test_get_compact(self, client):
+        """
+        Tests the compact representation selected with the Accept header.
+        Checks that it has no controls, that its rows match the Mason items,
+        that pagination and streaming work and that the two representations
+        have their own cache entries and ETags.
+        """
+
+        headers = {"Accept": COMPACT}
+        resp = client.get(self.RESOURCE_URL + "?limit=5&fields=throws", headers=headers)
+        assert resp.status_code == 200
+        assert resp.mimetype == COMPACT
+        assert "Accept" in resp.headers["Vary"]
+        body = json.loads(resp.data)
+        assert "@controls" not in body
+        assert body["fields"] == ["score_id", "throws"]
+        assert body["items"][0] == [1, 54]
+        assert body["prev"] is None
+        body = json.loads(client.get(body["next"], headers=headers).data)
+        assert [row[0] for row in body["items"]] == [6, 7, 8]
+        assert body["next"] is None
+
+        mason = json.loads(client.get(self.RESOURCE_URL).data)
+        compact = json.loads(client.get(self.RESOURCE_URL, headers=headers).data)
+        fields = compact["fields"]
+        assert [dict(zip(fields, row)) for row in compact["items"]] == [
+            {name: item[name] for name in fields} for item in mason["items"]
+        ]
+        resp = client.get(self.RESOURCE_URL + "?stream=1", headers=headers)
+        assert resp.is_streamed
+        assert json.loads(resp.data)["items"] == compact["items"]
+
+        first = client.get(self.RESOURCE_URL, headers=headers)
+        second = client.get(self.RESOURCE_URL, headers={"Accept": MASON})
+        assert first.headers["ETag"] != second.headers["ETag"]
+        assert second.mimetype == MASON
+        assert client.get(self.RESOURCE_URL, headers={"Accept": "*/*"}).mimetype == MASON
+
+        resp = client.get("/api/players/", headers=headers)
+        body = json.loads(resp.data)
+        assert body["fields"] == ["player_id", "name"]
+        assert body["items"][0] == [1, "test-player-0"]
+
+    def test_get_by_date(self, client):
+        """
+        Tests the date range and ordering parameters of the GET method. Adds
+        rounds with known dates, then checks from/to filtering, descending
+        date order with keyset pagination and that invalid values give 400.
+        """
+
+        for day in range(1, 6):
+            valid = _get_score_json(2)
+            valid["date"] = "2019-05-0{}".format(day)
+            resp = client.post(self.RESOURCE_URL, json=valid)
+            assert resp.status_code == 201
+
+        resp = client.get(self.RESOURCE_URL, query_string={"from": "2019-05-02", "to": "2019-05-04"})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["date"] for item in body["items"]] == ["2019-05-02", "2019-05-03", "2019-05-04"]
+
+        dates = []
+        href = self.RESOURCE_URL + "?player_id=2&to=2019-12-31&order=desc&limit=2"
+        while href:
+            body = json.loads(client.get(href).data)
+            dates.extend(item["date"] for item in body["items"])
+            href = body["@controls"].get("next", {}).get("href")
+        assert dates == ["2019-05-05", "2019-05-04", "2019-05-03", "2019-05-02", "2019-05-01"]
+        resp = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [item["date"] for item in body["items"]] == ["2019-05-03", "2019-05-02"]
+
+        resp = client.get(self.RESOURCE_URL, query_string={"from": "2019-02-30"})
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL, query_string={"order": "sideways"})
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL, query_string={"order": "asc", "after": "12"})
+        assert resp.status_code == 400
+
+    def test_get_expanded(self, client):
+        """
+        Tests embedding player and course names with "expand". Checks that
+        the names are correct, that one query fetches the page, that the
+        expansion is carried over to the next page, and that unknown
+        expansions give 400.
+        """
+
+        resp, statements = _count_statements(client, "get", self.RESOURCE_URL + "?expand=player,course&limit=5")
+        assert resp.status_code == 200
+        assert len(statements) == 1
+        body = json.loads(resp.data)
+        for item in body["items"]:
+            assert item["player_name"] == "test-player-{}".format(item["player_id"] - 1)
+            assert item["course_name"] == "test-course-{}".format(item["course_id"] - 1)
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 3
+        assert all("player_name" in item and "course_name" in item for item in body["items"])
+
+        body = json.loads(client.get(self.RESOURCE_URL + "?expand=course").data)
+        assert "player_name" not in body["items"][0]
+        assert body["items"][0]["course_name"] == "test-course-0"
+        body = json.loads(client.get(self.RESOURCE_URL + "?expand=player,course&course_id=2&player_id=2").data)
+        assert [item["score_id"] for item in body["items"]] == [2, 6]
+
+        # renaming a player changes expanded listings only
+        plain = client.get(self.RESOURCE_URL)
+        expanded = client.get(self.RESOURCE_URL + "?expand=player")
+        client.put("/api/players/1/", json=_get_player_json(9))
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": plain.headers["ETag"]})
+        assert resp.status_code == 304
+        resp = client.get(self.RESOURCE_URL + "?expand=player", headers={"If-None-Match": expanded.headers["ETag"]})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"][0]["player_name"] == "extra-player-9"
+
+        resp = client.get(self.RESOURCE_URL + "?expand=sensor")
+        assert resp.status_code == 400
+
     def test_get_by_player(self, client):
         """
         Tests the GET method filtered by player id. Checks that the response status code is 200, and
@@ -717,12 +1202,255 @@ class TestScoreCollection(object):
         valid["date"] = "01-01-2020"
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
+
+        # date in the right format that doesn't exist
+        valid["date"] = "2020-02-30"
+        resp = client.post(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 400
         
         # create invalid request body for 400
         valid.pop("player_id")
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
 
+class TestScoreQueryPlans(object):
+    """
+    This class checks that the filter branches of the score collection and
+    the cascading deletes use the indexes of the score table.
+    """
+
+    def test_get_by_player(self, client):
+        _check_no_full_scan(_get_query_plans(client, "get", "/api/scores/?player_id=1"), sort=False)
+
+    def test_get_by_course(self, client):
+        _check_no_full_scan(_get_query_plans(client, "get", "/api/scores/?course_id=1"), sort=False)
+
+    def test_get_by_player_and_course(self, client):
+        _check_no_full_scan(_get_query_plans(client, "get", "/api/scores/?player_id=1&course_id=1"), sort=False)
+
+    def test_get_next_page_by_player_and_course(self, client):
+        _check_no_full_scan(_get_query_plans(
+            client, "get", "/api/scores/?player_id=1&course_id=1&after=1&limit=1"
+        ), sort=False)
+
+    def test_get_latest_by_player(self, client):
+        _check_no_full_scan(_get_query_plans(
+            client, "get", "/api/scores/?player_id=1&order=desc&limit=20&from=2020-01-01"
+        ))
+
+    def test_player_stats(self, client):
+        _check_no_full_scan(_get_query_plans(client, "get", "/api/players/1/stats/"))
+
+    def test_delete_player(self, client):
+        _check_no_full_scan(_get_query_plans(client, "delete", "/api/players/1/"))
+
+    def test_delete_course(self, client):
+        _check_no_full_scan(_get_query_plans(client, "delete", "/api/courses/1/"))
+
+class TestScoreBulk(object):
+    """
+    This class implements tests for adding many scores at once.
+    """
+
+    RESOURCE_URL = "/api/scores/bulk/"
+
+    def test_control(self, client):
+        """
+        Checks that the score collection links to the bulk endpoint with a
+        schema that accepts an array of scores.
+        """
+
+        body = json.loads(client.get("/api/scores/").data)
+        ctrl = body["@controls"]["frolf:add-scores"]
+        assert ctrl["method"] == "POST"
+        assert ctrl["href"] == self.RESOURCE_URL
+        validate([_get_score_json(1), _get_score_json(2)], ctrl["schema"])
+
+    def test_post(self, client):
+        """
+        Tests the POST method. Sends a batch with valid items and items that
+        fail in different ways, and checks the per-item results and that only
+        the valid scores were added.
+        """
+
+        invalid = _get_score_json()
+        invalid.pop("throws")
+        missing_player = _get_score_json()
+        missing_player["player_id"] = 999
+        missing_course = _get_score_json()
+        missing_course["course_id"] = 999
+        batch = [_get_score_json(1), invalid, missing_player, _get_score_json(2), missing_course]
+
+        resp = client.post(self.RESOURCE_URL, json=batch)
+        assert resp.status_code == 200
+        items = json.loads(resp.data)["items"]
+        assert [item["status"] for item in items] == [201, 400, 404, 201, 404]
+        assert [items[0]["score_id"], items[3]["score_id"]] == [9, 10]
+        assert "@error" in items[1]
+
+        resp = client.get(items[3]["@controls"]["self"]["href"])
+        body = json.loads(resp.data)
+        assert body["throws"] == 20
+        assert body["player_id"] == 2
+        body = json.loads(client.get("/api/scores/").data)
+        assert len(body["items"]) == 10
+
+        # test with wrong content type and with a single object
+        resp = client.post(self.RESOURCE_URL, data=json.dumps(batch))
+        assert resp.status_code == 415
+        resp = client.post(self.RESOURCE_URL, json=_get_score_json())
+        assert resp.status_code == 400
+
+    def test_post_empty(self, client):
+        resp = client.post(self.RESOURCE_URL, json=[])
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"] == []
+
+    def test_post_too_many(self, client):
+        client.application.config["BULK_MAX_ITEMS"] = 2
+        resp = client.post(self.RESOURCE_URL, json=[_get_score_json()] * 3)
+        assert resp.status_code == 413
+
+class TestScoreStream(object):
+    """
+    This class implements tests for the live score stream.
+    """
+
+    RESOURCE_URL = "/api/scores/live/"
+
+    def _read_event(self, chunks):
+        # Skips the comments sent while waiting, for a few seconds at most
+        for _, chunk in zip(range(500), chunks):
+            chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+            if not chunk.startswith(":"):
+                lines = chunk.strip().split("\n")
+                return lines[0][len("event: "):], json.loads(lines[1][len("data: "):])
+
+    def test_get(self, client):
+        """
+        Subscribes to the scores of one course, then checks that created,
+        updated and deleted scores of that course are pushed and that the
+        scores of other courses are not.
+        """
+
+        client.application.config["LIVE_HEARTBEAT"] = 0.01
+        client.application.config["LIVE_POLL_INTERVAL"] = 0.01
+        resp = client.get(self.RESOURCE_URL + "?course_id=1")
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/event-stream"
+        chunks = iter(resp.response)
+        assert next(chunks).decode().startswith(":")
+
+        other = _get_score_json(2)
+        client.post("/api/scores/", json=other)
+        score = _get_score_json(1)
+        client.post("/api/scores/", json=score)
+        event, data = self._read_event(chunks)
+        assert event == "score-created"
+        assert data["score_id"] == 10
+        assert data["throws"] == score["throws"]
+        assert data["@controls"]["self"]["href"] == "/api/scores/10/"
+
+        score["throws"] = 99
+        client.put("/api/scores/10/", json=score)
+        event, data = self._read_event(chunks)
+        assert event == "score-updated"
+        assert data["throws"] == 99
+
+        client.post("/api/scores/bulk/", json=[other, score])
+        event, data = self._read_event(chunks)
+        assert (event, data["score_id"]) == ("score-created", 12)
+
+        client.delete("/api/scores/1/")
+        event, data = self._read_event(chunks)
+        assert (event, data["score_id"]) == ("score-deleted", 1)
+
+        resp.close()
+        assert client.application.extensions["event_hub"].stats()["subscribers"] == 0
+
+        resp = client.get(self.RESOURCE_URL + "?course_id=x")
+        assert resp.status_code == 400
+
+    def test_slow_subscriber(self, client):
+        """
+        Checks that a subscriber that doesn't read keeps only the latest
+        events and is told how many were dropped.
+        """
+
+        client.application.config["LIVE_HEARTBEAT"] = 0.01
+        hub = client.application.extensions["event_hub"]
+        hub.max_events = 2
+        resp = client.get(self.RESOURCE_URL)
+        chunks = iter(resp.response)
+        next(chunks)
+
+        for i in range(5):
+            client.post("/api/scores/", json=_get_score_json(1))
+        hub.poll()
+        event, data = self._read_event(chunks)
+        assert (event, data) == ("overflow", {"dropped": 3})
+        event, data = self._read_event(chunks)
+        assert data["score_id"] == 12
+        event, data = self._read_event(chunks)
+        assert data["score_id"] == 13
+        resp.close()
+
+    def test_after_pruning(self, client):
+        """
+        Checks that events written after every earlier event has been
+        pruned are still delivered.
+        """
+
+        app = client.application
+        app.config["LIVE_HEARTBEAT"] = 0.01
+        app.config["LIVE_RETENTION"] = 0
+        hub = app.extensions["event_hub"]
+        resp = client.get(self.RESOURCE_URL)
+        chunks = iter(resp.response)
+        next(chunks)
+
+        for score_id in (9, 10):
+            client.post("/api/scores/", json=_get_score_json(1))
+            hub.poll()
+            event, data = self._read_event(chunks)
+            assert (event, data["score_id"]) == ("score-created", score_id)
+            with app.app_context():
+                assert LiveEvent.query.count() == 0
+        resp.close()
+
+    def test_other_process(self, client):
+        """
+        Checks that a score added through another app, like another worker
+        process, is pushed to the subscribers of this one, and that streams
+        over LIVE_MAX_SUBSCRIBERS are refused.
+        """
+
+        app = client.application
+        app.config["LIVE_HEARTBEAT"] = 0.01
+        app.config["LIVE_POLL_INTERVAL"] = 0.01
+        app.extensions["event_hub"].max_subscribers = 2
+        resp = client.get(self.RESOURCE_URL)
+        chunks = iter(resp.response)
+        next(chunks)
+
+        other = create_app({
+            "SQLALCHEMY_DATABASE_URI": app.config["SQLALCHEMY_DATABASE_URI"],
+            "TESTING": True
+        })
+        assert other.test_client().post("/api/scores/", json=_get_score_json(2)).status_code == 201
+        event, data = self._read_event(chunks)
+        assert (event, data["score_id"], data["course_id"]) == ("score-created", 9, 2)
+
+        second = client.get(self.RESOURCE_URL)
+        resp3 = client.get(self.RESOURCE_URL)
+        assert resp3.status_code == 503
+        assert "Retry-After" in resp3.headers
+        second.close()
+        resp.close()
+        assert app.extensions["event_hub"].stats()["subscribers"] == 0
+        with other.app_context():
+            db.engine.dispose()
+
 class TestScoreItem(object):
     
     RESOURCE_URL = "/api/scores/1/"
@@ -750,6 +1478,20 @@ class TestScoreItem(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_get_expanded(self, client):
+        """
+        Tests embedding player and course names in a score with one query.
+        """
+
+        resp, statements = _count_statements(client, "get", self.RESOURCE_URL + "?expand=player,course")
+        assert resp.status_code == 200
+        assert len(statements) == 1
+        body = json.loads(resp.data)
+        assert body["player_name"] == "test-player-0"
+        assert body["course_name"] == "test-course-0"
+        resp = client.get(self.RESOURCE_URL + "?expand=players")
+        assert resp.status_code == 400
+
     def test_put(self, client):
         """
         Tests the PUT method. Checks all of the possible erroe codes, and also
@@ -815,6 +1557,610 @@ class TestScoreItem(object):
         assert resp.status_code == 404
 
 
+class TestChangeFeed(object):
+    """
+    This class implements tests for the change feed.
+    """
+
+    RESOURCE_URL = "/api/changes/"
+
+    def test_get(self, client):
+        """
+        Makes changes through the other resources and checks that they are
+        listed in order, that the cursor only returns the changes after it and
+        that the cascaded score deletions are recorded.
+        """
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        assert body["items"] == []
+        assert body["cursor"] == 0
+        assert body["more"] is False
+
+        client.post("/api/players/", json=_get_player_json())
+        client.put("/api/courses/1/", json=_get_course_json())
+        client.post("/api/scores/bulk/", json=[_get_score_json(1), _get_score_json(2)])
+        client.delete("/api/scores/2/")
+        client.delete("/api/players/1/")
+
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        changes = [(item["resource"], item["id"], item["operation"]) for item in body["items"]]
+        assert changes == [
+            ("player", 5, "create"),
+            ("course", 1, "update"),
+            ("score", 9, "create"),
+            ("score", 10, "create"),
+            ("score", 2, "delete"),
+            ("score", 1, "delete"),
+            ("score", 5, "delete"),
+            ("score", 9, "delete"),
+            ("player", 1, "delete"),
+        ]
+        assert body["cursor"] == body["items"][-1]["change_id"]
+        resp = client.get(body["items"][0]["@controls"]["about"]["href"])
+        assert resp.status_code == 200
+
+        # a consumer that is up to date gets an empty page
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert body["items"] == []
+        client.put("/api/players/2/", json=_get_player_json(2))
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        assert [(item["resource"], item["id"]) for item in body["items"]] == [("player", 2)]
+
+    def test_get_paginated(self, client):
+        for i in range(5):
+            client.post("/api/players/", json=_get_player_json(i))
+
+        body = json.loads(client.get(self.RESOURCE_URL + "?limit=2").data)
+        ids = [item["id"] for item in body["items"]]
+        while body["more"]:
+            body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+            ids.extend(item["id"] for item in body["items"])
+        assert ids == [5, 6, 7, 8, 9]
+
+        resp = client.get(self.RESOURCE_URL + "?since=x")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?limit=1001")
+        assert resp.status_code == 400
+
+    def test_query_plan(self, client):
+        client.post("/api/players/", json=_get_player_json())
+        _check_no_full_scan(
+            _get_query_plans(client, "get", self.RESOURCE_URL + "?since=1", table="change"), table="change"
+        )
+
+class TestBinaryFormats(object):
+    """
+    This class implements tests for the MessagePack representations and
+    request bodies.
+    """
+
+    MSGPACK = "application/vnd.mason+msgpack"
+
+    def test_get(self, client):
+        """
+        Checks that items, collections, streamed collections and errors are
+        encoded as MessagePack when it's preferred, and that the documents
+        are the same as the JSON ones.
+        """
+
+        msgpack = pytest.importorskip("msgpack")
+        headers = {"Accept": self.MSGPACK + ", " + MASON + ";q=0.5"}
+        for url in ["/api/", "/api/scores/1/", "/api/scores/?limit=3", "/api/courses/1/leaderboard/"]:
+            resp = client.get(url, headers=headers)
+            assert resp.status_code == 200
+            assert resp.mimetype == self.MSGPACK
+            assert msgpack.unpackb(resp.data) == json.loads(client.get(url).data)
+
+        resp = client.get("/api/scores/?stream=1", headers=headers)
+        assert len(msgpack.unpackb(resp.data)["items"]) == 8
+        resp = client.get("/api/scores/", headers={"Accept": "application/vnd.frolftracker.compact+msgpack"})
+        assert msgpack.unpackb(resp.data)["items"][0] == [1, 54, date.today().isoformat(), 1, 1]
+
+        resp = client.get("/api/scores/999/", headers=headers)
+        assert resp.status_code == 404
+        assert "@error" in msgpack.unpackb(resp.data)
+
+        first = client.get("/api/scores/1/", headers=headers)
+        second = client.get("/api/scores/1/")
+        assert first.headers["ETag"] != second.headers["ETag"]
+
+    def test_post(self, client):
+        """
+        Sends new resources as MessagePack and checks that they're added, and
+        that a body that can't be decoded gives 400.
+        """
+
+        msgpack = pytest.importorskip("msgpack")
+        headers = {"Content-Type": self.MSGPACK}
+        resp = client.post("/api/players/", data=msgpack.packb(_get_player_json()), headers=headers)
+        assert resp.status_code == 201
+        resp = client.post("/api/scores/bulk/", data=msgpack.packb([_get_score_json(4)]), headers=headers)
+        assert json.loads(resp.data)["items"][0]["status"] == 201
+        body = json.loads(client.get("/api/scores/9/").data)
+        assert body["throws"] == 40
+
+        resp = client.post("/api/players/", data=b"\xc1", headers=headers)
+        assert resp.status_code == 400
+
+class TestCompression(object):
+    """
+    This class implements tests for response compression.
+    """
+
+    HEADERS = {"Accept-Encoding": "gzip"}
+
+    def test_get(self, client):
+        """
+        Checks that responses above the size threshold are compressed when
+        the client accepts gzip, that small ones and responses to clients
+        that don't accept it are not, and that the ETag of a compressed
+        response works for conditional requests.
+        """
+
+        plain = client.get("/api/scores/")
+        assert "Content-Encoding" not in plain.headers
+        resp = client.get("/api/scores/", headers=self.HEADERS)
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in resp.headers["Vary"]
+        assert gzip.decompress(resp.data) == plain.data
+        assert len(resp.data) < len(plain.data)
+        assert resp.headers["ETag"] == "W/" + plain.headers["ETag"]
+
+        resp = client.get("/api/scores/", headers=dict(self.HEADERS, **{"If-None-Match": resp.headers["ETag"]}))
+        assert resp.status_code == 304
+
+        resp = client.get("/api/players/1/", headers=self.HEADERS)
+        assert len(resp.data) < client.application.config["COMPRESS_MIN_SIZE"]
+        assert "Content-Encoding" not in resp.headers
+
+    def test_cached(self, client, monkeypatch):
+        """
+        Checks that a cached response is compressed only once, and that the
+        uncached and streamed responses are compressed too.
+        """
+
+        from frolftracker import compress
+        calls = []
+
+        def counting_gzip(data):
+            calls.append(len(data))
+            return gzip.compress(data)
+
+        monkeypatch.setitem(compress.CODINGS, "gzip", counting_gzip)
+        first = client.get("/api/scores/", headers=self.HEADERS)
+        second = client.get("/api/scores/", headers=self.HEADERS)
+        assert first.data == second.data
+        assert len(calls) == 1
+        assert client.application.extensions["response_cache"].stats()["hits"] == 1
+
+        client.application.config["COMPRESS_MIN_SIZE"] = 0
+        client.post("/api/players/", json=_get_player_json())
+        resp = client.get("/api/changes/", headers=self.HEADERS)
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert json.loads(gzip.decompress(resp.data))["items"][0]["resource"] == "player"
+
+        resp = client.get("/api/scores/?stream=1", headers=self.HEADERS)
+        assert resp.is_streamed
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(resp.data) == client.get("/api/scores/").data
+
+class TestConditionalGet(object):
+    """
+    This class implements tests for ETags and conditional GET requests.
+    """
+
+    def test_collection(self, client):
+        """
+        Checks that a collection answers a matching If-None-Match with 304
+        without querying the collection, and that adding an item changes
+        the ETag.
+        """
+
+        resp = client.get("/api/scores/")
+        assert resp.status_code == 200
+        etag = resp.headers["ETag"]
+
+        statements = []
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        with client.application.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", capture)
+        try:
+            resp = client.get("/api/scores/", headers={"If-None-Match": etag})
+        finally:
+            event.remove(engine, "before_cursor_execute", capture)
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+        assert resp.data == b""
+        assert len(statements) == 1
+        assert "table_version" in statements[0]
+
+        # filters and page parameters are part of the representation
+        resp = client.get("/api/scores/?player_id=1", headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+
+        # changes to other tables don't invalidate the scores
+        client.post("/api/players/", json=_get_player_json())
+        resp = client.get("/api/scores/", headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+
+        client.post("/api/scores/", json=_get_score_json())
+        resp = client.get("/api/scores/", headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+
+    def test_item(self, client):
+        """
+        Checks ETags of an item through an update and a cascading delete.
+        """
+
+        resp = client.get("/api/scores/1/")
+        etag = resp.headers["ETag"]
+        resp = client.get("/api/scores/1/", headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+
+        client.put("/api/courses/2/", json=_get_course_json(7))
+        resp = client.get("/api/scores/1/", headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+
+        client.delete("/api/players/1/")
+        resp = client.get("/api/scores/1/", headers={"If-None-Match": etag})
+        assert resp.status_code == 404
+        assert "ETag" not in resp.headers
+
+class TestResponseCache(object):
+    """
+    This class implements tests for the in-process response cache.
+    """
+
+    def test_hit_and_invalidation(self, client):
+        """
+        Checks that repeated GETs are served from the cache, that writes only
+        evict the entries of the tables they change, and that the counters
+        are exposed.
+        """
+
+        cache = client.application.extensions["response_cache"]
+        first = client.get("/api/scores/?course_id=1")
+        client.get("/api/courses/")
+        second = client.get("/api/scores/?course_id=1")
+        assert second.data == first.data
+        assert second.headers["ETag"] == first.headers["ETag"]
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["entries"] == 2
+
+        # query parameter order doesn't matter
+        client.get("/api/scores/?limit=5&course_id=1")
+        client.get("/api/scores/?course_id=1&limit=5")
+        assert cache.stats()["hits"] == 2
+
+        resp = client.post("/api/scores/", json=_get_score_json())
+        assert resp.status_code == 201
+        assert cache.stats()["entries"] == 1
+        resp = client.get("/api/scores/?course_id=1")
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 3
+        client.get("/api/courses/")
+        assert cache.stats()["hits"] == 3
+
+        resp = client.get("/stats/cache/")
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == cache.stats()
+
+    def test_eviction(self, client):
+        """
+        Checks that the cache never grows over its configured size and that
+        the least recently used entry is evicted first.
+        """
+
+        cache = client.application.extensions["response_cache"]
+        cache.max_entries = 2
+        client.get("/api/players/1/")
+        client.get("/api/players/2/")
+        client.get("/api/players/1/")
+        client.get("/api/players/3/")
+        stats = cache.stats()
+        assert stats["entries"] == 2
+        assert stats["evictions"] == 1
+        client.get("/api/players/1/")
+        assert cache.stats()["hits"] == 2
+
+    def test_byte_limit(self, client):
+        """
+        Checks that the plain and compressed bodies of the entries are
+        counted against the byte limit, and that responses larger than the
+        whole cache aren't stored.
+        """
+
+        cache = client.application.extensions["response_cache"]
+        client.application.config["COMPRESS_MIN_SIZE"] = 0
+        size = len(client.get("/api/players/1/").data)
+        assert cache.stats()["bytes"] == size
+        compressed = len(client.get("/api/players/1/", headers={"Accept-Encoding": "gzip"}).data)
+        assert cache.stats()["bytes"] == size + compressed
+
+        cache.max_bytes = size + compressed + size
+        client.get("/api/players/2/")
+        assert cache.stats()["entries"] == 2
+        client.get("/api/players/3/")
+        stats = cache.stats()
+        assert stats["entries"] == 2
+        assert stats["evictions"] == 1
+        assert stats["bytes"] <= cache.max_bytes
+
+        cache.max_bytes = size - 1
+        hits = cache.stats()["hits"]
+        client.get("/api/players/4/")
+        client.get("/api/players/4/")
+        assert cache.stats()["hits"] == hits
+
+    def test_disabled(self, client):
+        cache = client.application.extensions["response_cache"]
+        cache.max_entries = 0
+        client.get("/api/players/")
+        client.get("/api/players/")
+        assert cache.stats()["entries"] == 0
+        assert cache.stats()["hits"] == 0
+
+class TestMetrics(object):
+    """
+    This class implements tests for the Prometheus metrics endpoint.
+    """
+
+    RESOURCE_URL = "/metrics"
+
+    def _get_metrics(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/plain"
+        metrics = {}
+        for line in resp.data.decode().splitlines():
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                metrics[name] = float(value)
+        return metrics
+
+    def test_get(self, client):
+        """
+        Makes requests and checks that their counts, latencies, sizes and SQL
+        statements are reported per endpoint and method, and that requests
+        outside the API are not measured.
+        """
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with client.application.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", capture)
+        try:
+            sizes = [len(client.get("/api/players/{}/".format(i)).data) for i in (1, 2)]
+        finally:
+            event.remove(engine, "before_cursor_execute", capture)
+        client.get("/api/players/999/")
+        client.post("/api/players/", json=_get_player_json())
+        client.get("/profiles/player/")
+
+        metrics = self._get_metrics(client)
+        labels = '{endpoint="api.playeritem",method="GET"}'
+        assert metrics['frolftracker_requests_total{endpoint="api.playeritem",method="GET",status="200"}'] == 2
+        assert metrics['frolftracker_requests_total{endpoint="api.playeritem",method="GET",status="404"}'] == 1
+        assert metrics['frolftracker_requests_total{endpoint="api.playercollection",method="POST",status="201"}'] == 1
+        assert metrics["frolftracker_request_duration_seconds_count" + labels] == 3
+        assert metrics[
+            'frolftracker_request_duration_seconds_bucket{endpoint="api.playeritem",method="GET",le="+Inf"}'
+        ] == 3
+        assert metrics["frolftracker_request_duration_seconds_sum" + labels] > 0
+        assert metrics["frolftracker_response_bytes_total" + labels] > sum(sizes)
+        assert metrics["frolftracker_sql_statements_total" + labels] >= len(statements)
+        assert metrics["frolftracker_sql_duration_seconds_total" + labels] > 0
+        assert not any("send_profile" in name for name in metrics)
+        assert metrics["frolftracker_response_cache_misses_total"] == 3
+
+        # a cache hit only reads the version counters
+        client.get("/api/players/1/")
+        before = self._get_metrics(client)["frolftracker_sql_statements_total" + labels]
+        client.get("/api/players/1/")
+        metrics = self._get_metrics(client)
+        assert metrics["frolftracker_sql_statements_total" + labels] == before + 1
+        assert metrics["frolftracker_response_cache_hits_total"] == 1
+
+    def test_workers(self, client, tmp_path):
+        """
+        Checks that the metrics of every worker process are added up, also
+        after a worker has exited, and that gauges are reported per worker.
+        """
+
+        registry = client.application.extensions["metrics"]
+        registry.directory = str(tmp_path)
+        client.get("/api/players/")
+        client.get("/api/players/")
+        registry.flush()
+        # another worker that has served the same requests
+        own = tmp_path / "{}.json".format(os.getpid())
+        (tmp_path / "1.json").write_text(own.read_text())
+
+        labels = '{endpoint="api.playercollection",method="GET",status="200"}'
+        metrics = self._get_metrics(client)
+        assert metrics["frolftracker_requests_total" + labels] == 4
+        assert metrics["frolftracker_response_cache_hits_total"] == 2
+        assert 'frolftracker_live_subscribers{worker="1"}' in metrics
+        assert 'frolftracker_live_subscribers{worker="%d"}' % os.getpid() in metrics
+
+        mark_process_dead(str(tmp_path), 1)
+        metrics = self._get_metrics(client)
+        assert metrics["frolftracker_requests_total" + labels] == 4
+        assert 'frolftracker_live_subscribers{worker="1"}' not in metrics
+        assert not (tmp_path / "1.json").exists()
+
+def _get_budget_requests(scale):
+    """
+    Returns a request to every endpoint and method as (method, URL, JSON)
+    tuples, for a database loaded with _get_query_counts. The bulk request
+    grows with *scale* and spans every course.
+    """
+
+    bulk = [
+        {"throws": 40 + i % 20, "date": "2020-06-22", "player_id": i % scale + 1, "course_id": i % scale + 1}
+        for i in range(scale * 2)
+    ]
+    return [
+        ("get", "/api/", None),
+        ("get", "/api/players/", None),
+        ("post", "/api/players/", _get_player_json()),
+        ("get", "/api/players/1/", None),
+        ("put", "/api/players/2/", _get_player_json(2)),
+        ("get", "/api/players/1/stats/", None),
+        ("get", "/api/courses/", None),
+        ("post", "/api/courses/", _get_course_json()),
+        ("get", "/api/courses/1/", None),
+        ("put", "/api/courses/2/", _get_course_json(2)),
+        ("get", "/api/courses/1/leaderboard/", None),
+        ("get", "/api/scores/", None),
+        ("get", "/api/scores/?expand=player,course", None),
+        ("get", "/api/scores/?player_id=1&order=desc", None),
+        ("post", "/api/scores/", {"throws": 40, "date": "2020-06-22", "player_id": 1, "course_id": 1}),
+        ("post", "/api/scores/bulk/", bulk),
+        ("get", "/api/scores/1/?expand=player,course", None),
+        ("put", "/api/scores/1/", {"throws": 41, "date": "2020-06-22", "player_id": 1, "course_id": 2}),
+        ("delete", "/api/scores/2/", None),
+        ("delete", "/api/players/3/", None),
+        ("delete", "/api/courses/3/", None),
+        ("get", "/api/changes/", None),
+    ]
+
+def _get_query_counts(scale):
+    """
+    Loads *scale* players and courses with ten rounds per course into a new
+    database and sends the budget requests to it with the response cache
+    disabled. The leaderboards never fill up, so every change of a round
+    takes the most expensive path of refreshing them. Returns the SQL
+    statement counts of the requests.
+    """
+
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "QUERY_BUDGET_MODE": "error",
+        "RESPONSE_CACHE_SIZE": 0,
+        "PAGE_SIZE": 1000,
+        "LEADERBOARD_SIZE": 1000
+    })
+    with app.app_context():
+        db.create_all()
+        load_data(players=scale, courses=scale, scores=scale * 10, seed=1, keep_indexes=True)
+        # the budget requests move the first round to another course
+        db.session.execute(update(Score).where(Score.id == 1).values(course_id=1))
+        db.session.commit()
+
+    client = app.test_client()
+    counts = {}
+    try:
+        for method, url, doc in _get_budget_requests(scale):
+            resp = getattr(client, method)(url, json=doc)
+            assert resp.status_code < 300, (method, url, resp.data)
+            counts[method.upper(), url] = int(resp.headers["X-Query-Count"])
+    finally:
+        with app.app_context():
+            db.engine.dispose()
+        os.close(db_fd)
+        os.unlink(db_fname)
+    return counts
+
+class TestQueryBudget(object):
+    """
+    This class implements tests for the query budgets of the resource
+    methods.
+    """
+
+    def test_declared(self):
+        """
+        Checks that every method of every resource declares a query budget.
+        """
+
+        for resource, urls, kwargs in api.api.resources:
+            for method in resource.methods:
+                budget = getattr(getattr(resource, method.lower()), "query_budget", None)
+                assert isinstance(budget, int), (resource.__name__, method)
+
+    def test_scales(self):
+        """
+        Sends the same requests to databases of three sizes and checks that
+        they stay within their budgets and execute the same number of SQL
+        statements whatever the size, so that N+1 query patterns fail the
+        build.
+        """
+
+        small, medium, large = (_get_query_counts(scale) for scale in (3, 10, 40))
+        assert small == medium == large
+
+    def test_full_bulk(self, client):
+        """
+        Adds a batch of BULK_MAX_ITEMS scores, more than SQLAlchemy inserts
+        with one statement by default, and checks that it executes as many
+        SQL statements as a batch of two and stays within the budget.
+        """
+
+        app = client.application
+        app.config["QUERY_BUDGET_MODE"] = "error"
+        resp = client.post("/api/scores/bulk/", json=[_get_score_json()] * 2)
+        assert resp.status_code == 200
+        count = resp.headers["X-Query-Count"]
+        with app.app_context():
+            before = Score.query.count()
+
+        resp = client.post("/api/scores/bulk/", json=[_get_score_json()] * app.config["BULK_MAX_ITEMS"])
+        assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == count
+        body = json.loads(resp.data)
+        assert [item["status"] for item in body["items"]] == [201] * app.config["BULK_MAX_ITEMS"]
+        with app.app_context():
+            assert Score.query.count() == before + app.config["BULK_MAX_ITEMS"]
+
+    def test_over_budget(self, client, monkeypatch, caplog):
+        """
+        Lowers the budget of methods below what they need and checks that the
+        requests fail without writing anything in the error mode and are
+        logged in the warn mode.
+        """
+
+        monkeypatch.setattr(PlayerCollection, "get", query_budget(1)(PlayerCollection.get.__wrapped__))
+        resp = client.get("/api/players/")
+        assert resp.status_code == 500
+        body = json.loads(resp.data)
+        assert body["@error"]["@message"] == "Query budget exceeded"
+        assert "over its budget of 1" in body["@error"]["@messages"][0]
+        assert resp.headers["X-Query-Count"] == "1"
+        assert resp.headers["X-Query-Budget"] == "1"
+
+        monkeypatch.setattr(PlayerCollection, "post", query_budget(2)(PlayerCollection.post.__wrapped__))
+        resp = client.post("/api/players/", json=_get_player_json())
+        assert resp.status_code == 500
+        with client.application.app_context():
+            assert Player.query.count() == 4
+
+        client.application.config["QUERY_BUDGET_MODE"] = "warn"
+        resp = client.get("/api/players/?limit=2")
+        assert resp.status_code == 200
+        assert resp.headers["X-Query-Count"] == "2"
+        assert "api.playercollection executed 2 SQL statements" in caplog.text
+
+        client.application.config["QUERY_BUDGET_MODE"] = None
+        resp = client.get("/api/players/?limit=3")
+        assert resp.status_code == 200
+        assert "X-Query-Count" not in resp.headers
+
 class TestEntryPoint(object):
     
     RESOURCE_URL = "/api/"
@@ -833,3 +2179,86 @@ class TestEntryPoint(object):
         _check_control_get_method("frolf:players-all", client, body)
         _check_control_get_method("frolf:courses-all", client, body)
         _check_control_get_method("frolf:scores-all", client, body)
+        _check_control_get_method("frolf:changes", client, body)
+
+def test_cached_validators():
+    """
+    Checks that schema validators are built once per model and that they
+    report the same error as jsonschema.validate.
+    """
+
+    assert get_validator(Score) is get_validator(Score)
+    assert get_validator(Score) is not get_validator(Player)
+
+    invalid = _get_score_json()
+    invalid["date"] = "22.6.2020"
+    invalid.pop("throws")
+    with pytest.raises(ValidationError) as expected:
+        validate(invalid, Score.get_schema())
+    with pytest.raises(ValidationError) as cached:
+        validate_json(invalid, Score)
+    assert str(cached.value) == str(expected.value)
+
+def test_simple_checks():
+    """
+    Checks that the fast checks of the schemas only accept documents that
+    the validator accepts too.
+    """
+
+    documents = [
+        _get_score_json(),
+        dict(_get_score_json(), id=3, extra=[1]),
+        dict(_get_score_json(), throws=True),
+        dict(_get_score_json(), throws=54.0),
+        dict(_get_score_json(), player_id="1"),
+        dict(_get_score_json(), date="2020-6-1"),
+        dict(_get_score_json(), date="2020-06-01\n"),
+        dict(_get_score_json(), id=None),
+        {"throws": 54, "date": "2020-06-01"},
+        [_get_score_json()],
+        None,
+    ]
+    check = get_simple_check(Score)
+    for document in documents:
+        if check(document):
+            assert get_validator(Score).is_valid(document), document
+    assert check(documents[0]) and check(documents[1])
+    assert not check(documents[2]) and not check(documents[3])
+
+    assert get_simple_check(Player)({"name": "player"})
+    assert not get_simple_check(Player)({"name": 1})
+
+def test_item_serializers(client):
+    """
+    Checks that the item serializers produce byte-for-byte the same documents
+    as building the items with FrolftrackerBuilder and url_for.
+    """
+
+    app = client.application
+    with app.test_request_context("/api/"):
+        serialize = PLAYER_ITEM.bind()
+        for row, db_player in zip(PLAYER_ITEM.select(Player.query).order_by(Player.id), Player.query.order_by(Player.id)):
+            item = FrolftrackerBuilder(name=db_player.name)
+            item.add_control("self", url_for("api.playeritem", player_id=db_player.id))
+            item.add_control("profile", PLAYER_PROFILE)
+            assert json.dumps(serialize(row)) == json.dumps(item)
+
+        serialize = COURSE_ITEM.bind()
+        for row, db_course in zip(COURSE_ITEM.select(Course.query).order_by(Course.id), Course.query.order_by(Course.id)):
+            item = FrolftrackerBuilder(name=db_course.name, num_holes=db_course.num_holes, par=db_course.par)
+            item.add_control("self", url_for("api.courseitem", course_id=db_course.id))
+            item.add_control("profile", COURSE_PROFILE)
+            assert json.dumps(serialize(row)) == json.dumps(item)
+
+        serialize = SCORE_ITEM.bind()
+        for row, db_score in zip(SCORE_ITEM.select(Score.query).order_by(Score.id), Score.query.order_by(Score.id)):
+            item = FrolftrackerBuilder(
+                score_id=db_score.id,
+                throws=db_score.throws,
+                date=db_score.date.isoformat(),
+                player_id=db_score.player_id,
+                course_id=db_score.course_id,
+            )
+            item.add_control("self", url_for("api.scoreitem", score_id=db_score.id))
+            item.add_control("profile", SCORE_PROFILE)
+            assert json.dumps(serialize(row)) == json.dumps(item)